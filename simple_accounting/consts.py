@@ -18,4 +18,15 @@ from django.conf import settings
 
 # character(s) used to separate components of paths through account trees
 # try to retrieve it from project-level configuration, first; default to '/' if unset
-ACCOUNT_PATH_SEPARATOR = getattr(settings, 'ACCOUNT_PATH_SEPARATOR', '/')
\ No newline at end of file
+ACCOUNT_PATH_SEPARATOR = getattr(settings, 'ACCOUNT_PATH_SEPARATOR', '/')
+
+# whether the total amount of money stored within an accounting system should be cached 
+# (using Django's cache framework); cached values are invalidated as ledger entries are written 
+ACCOUNTING_CACHE_TOTAL_AMOUNT = getattr(settings, 'ACCOUNTING_CACHE_TOTAL_AMOUNT', False)
+# how long (in seconds) a cached total amount may be kept, at most
+ACCOUNTING_CACHE_TOTAL_AMOUNT_TIMEOUT = getattr(settings, 'ACCOUNTING_CACHE_TOTAL_AMOUNT_TIMEOUT', 300)
+
+# whether trees of accounts should be cached within each process (see ``AccountTree``);
+# cached trees are invalidated as accounts are saved or deleted by the *same* process,
+# so only enable this if account trees aren't changed by other processes while running 
+ACCOUNTING_CACHE_ACCOUNT_TREES = getattr(settings, 'ACCOUNTING_CACHE_ACCOUNT_TREES', False)
@@ -14,6 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
 
+from django.db import connections, router, transaction
+from django.db.models import AutoField
+
+from functools import wraps
+import threading
+
+
 def queryset_from_iterable(model, iterable):
     """
     Take a model class and an iterable containing instances of that model; 
@@ -31,4 +38,93 @@ def queryset_from_iterable(model, iterable):
         else:
             raise TypeError(_(u"Can't create a %(model)s QuerySet: %(obj)s is not an instance of model %(model)s"))
     qs = model._default_manager.filter(pk__in=id_set)
-    return qs
\ No newline at end of file
+    return qs
+
+
+def bulk_insert(model, objs):
+    """
+    Take a model class and a list of (unsaved) instances of that model, 
+    and insert them into the DB by a single multi-row statement.
+    
+    This is a minimal replacement for ``QuerySet.bulk_create()``, which isn't available 
+    in the Django version we support; as such, it shares its limitations:
+    * the ``.save()`` method of model instances isn't called, and no signals are sent
+    * primary keys of model instances are *not* set
+    * it doesn't work with multi-table inherited models
+    """
+    if not objs:
+        return
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields] for obj in objs]
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed(using=using)
+
+
+def atomic(func):
+    """
+    Decorator making a function run as a single unit of work against the (default) DB.
+    
+    This is a minimal replacement for ``transaction.atomic()``, which isn't available 
+    in the Django version we support:
+    * if no transaction is being managed yet, the function runs within ``commit_on_success``, 
+      so everything it writes is committed at once, or rolled back if it raises an exception
+    * otherwise (e.g. when called from another ``atomic`` function, or within a ``commit_on_success`` 
+      block), the function runs within a savepoint, so an exception rolls back only what 
+      it has written, leaving the enclosing transaction usable (and uncommitted)
+    
+    For instance, the ``register_*`` functions in ``simple_accounting.utils`` are ``atomic``: 
+    every row making up a transaction is written, or none is, even when a batch of them 
+    is registered within an enclosing ``atomic`` block.
+    
+    Note that on DB backends lacking savepoint support (e.g. SQLite), a failing nested call 
+    can't be rolled back on its own: it's up to the enclosing block to roll back as a whole.
+    """
+    @wraps(func)
+    def _atomic(*args, **kwargs):
+        if not transaction.is_managed():
+            # this is the outermost block, so it collects callbacks registered by ``on_commit`` 
+            _commit_callbacks.pending = []
+            try:
+                result = transaction.commit_on_success(func)(*args, **kwargs)
+                callbacks = _commit_callbacks.pending
+            finally:
+                _commit_callbacks.pending = None
+            for callback in callbacks:
+                callback()
+            return result
+        sid = transaction.savepoint()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+        return result
+    return _atomic
+
+
+_commit_callbacks = threading.local()
+
+def on_commit(func):
+    """
+    Call ``func`` (with no arguments) once the outermost ``atomic`` block run by 
+    the current thread has committed; if no ``atomic`` block is running, call it right away.
+    
+    If the block is rolled back, ``func`` is never called.  
+    
+    Note that if the transaction is managed by client code (e.g. within a ``commit_on_success``
+    block), there is no way to know when it's going to be committed, so ``func`` is called right away.
+    """
+    callbacks = getattr(_commit_callbacks, 'pending', None)
+    if callbacks is None:
+        func()
+    else:
+        callbacks.append(func)
@@ -0,0 +1,28 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-simple-accounting``.
+
+# ``django-simple-accounting`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-simple-accounting`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from simple_accounting.models import Account
+
+
+class Command(NoArgsCommand):
+    help = "Fill in the path stored along with every account. Meant to be run once, after upgrading an existing database."
+
+    def handle_noargs(self, **options):
+        Account.objects.rebuild_paths()
+        transaction.commit_unless_managed()
@@ -0,0 +1,32 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-simple-accounting``.
+
+# ``django-simple-accounting`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-simple-accounting`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from simple_accounting.models import LedgerAggregate
+from simple_accounting.exceptions import InvalidAccountingOperation
+
+
+class Command(NoArgsCommand):
+    help = "Refresh ledger aggregates, taking into account ledger entries which have not been aggregated yet. Meant to be run periodically as a cronjob."
+
+    def handle_noargs(self, **options):
+        try:
+            LedgerAggregate.objects.refresh()
+        except InvalidAccountingOperation, e:
+            raise CommandError(e)
+        transaction.commit_unless_managed()
@@ -0,0 +1,45 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-simple-accounting``.
+
+# ``django-simple-accounting`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-simple-accounting`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from simple_accounting.models import Account
+
+
+class Command(NoArgsCommand):
+    help = "Take a snapshot of the balance of every account at the end of the last month. Meant to be run monthly as a cronjob."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--period-end', dest='period_end', default=None,
+            help='Take snapshots at the given date (as YYYY-MM-DD), instead of at the end of the last month.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options.get('period_end'):
+            try:
+                period_end = datetime.strptime(options['period_end'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("Invalid date: %s (expected format is YYYY-MM-DD)" % options['period_end'])
+        else:
+            # the last month ends when the current one begins
+            today = datetime.today()
+            period_end = datetime(today.year, today.month, 1)
+        Account.objects.take_balance_snapshots(period_end)
+        transaction.commit_unless_managed()
@@ -14,16 +14,233 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import models
+from django.db import models, connections, router
 
-from simple_accounting.lib import queryset_from_iterable 
+from decimal import Decimal
+
+from simple_accounting.lib import queryset_from_iterable, atomic, bulk_insert
+
+
+def _total_amounts_by_owner(subjects):
+    """
+    Return a list of ``(subject_id, total_amount)`` pairs for the accounting systems 
+    owned by ``subjects`` (either a queryset or a list of IDs), using a single aggregate query.
+    
+    Subjects owning no stock-like accounts are missing from the result.
+    
+    It's a module-level function, so that it can be dispatched to worker processes.
+    """
+    from simple_accounting.models import Account, AccountType
+    stock_accounts = Account.objects.filter(system__owner__in=subjects, kind__base_type__in=(AccountType.ASSET, AccountType.LIABILITY))
+    return list(stock_accounts.values_list('system__owner').annotate(total=models.Sum('current_balance')))
+
+
+class AccountSystemManager(models.Manager):
+    """
+    A custom manager class for the ``AccountSystem`` model.
+    """
+    def total_amounts_for(self, subjects, processes=None, chunk_size=500):
+        """
+        Take a queryset of ``Subject`` model instances (``subjects``) and return a dictionary 
+        mapping their IDs to the total amount of money stored in the accounting systems 
+        they own (as computed by ``AccountSystem.total_amount``).
+        
+        By default, totals are computed by a single aggregate query. If ``processes`` is given, 
+        subjects are split into chunks of ``chunk_size`` and each chunk is processed (by one query) 
+        within a pool of that many worker processes; this is only worthwhile for very large installations, 
+        and requires a database accessible by multiple connections (i.e. not an in-memory SQLite one).
+        
+        Since the current DB connection has to be closed before forking worker processes, ``processes`` 
+        can't be used within a managed transaction (whose uncommitted changes would be lost): 
+        if so, raise ``InvalidAccountingOperation``.
+        """
+        subject_ids = list(subjects.values_list('pk', flat=True))
+        if processes:
+            from multiprocessing import Pool
+            from django.db import connection, transaction
+            from simple_accounting.exceptions import InvalidAccountingOperation
+            if transaction.is_managed():
+                raise InvalidAccountingOperation("Totals can't be computed by worker processes within a managed transaction")
+            # worker processes are forked, so they must not share the current DB connection
+            connection.close()
+            chunks = [subject_ids[i:i+chunk_size] for i in range(0, len(subject_ids), chunk_size)]
+            pool = Pool(processes)
+            try:
+                results = pool.map(_total_amounts_by_owner, chunks)
+            finally:
+                pool.close()
+                pool.join()
+            totals = dict(pair for result in results for pair in result)
+        else:
+            # let the DB filter subjects by a subquery
+            totals = dict(_total_amounts_by_owner(subjects.values('pk')))
+        total_amounts = {}
+        for subject_id in subject_ids:
+            total_amounts[subject_id] = totals.get(subject_id) or Decimal(0)
+        return total_amounts
 
 
 class AccountManager(models.Manager):
     """
     A custom manager class for the ``Account`` model.
     """
-    pass
+    def with_balances(self):
+        """
+        Return a queryset of accounts, each one retrieved along with its (persisted) balance, 
+        so accessing the ``.balance`` property of returned accounts doesn't hit the DB.
+        """
+        qn = connections[router.db_for_read(self.model)].ops.quote_name
+        balance_column = "%s.%s" % (qn(self.model._meta.db_table), qn(self.model._meta.get_field('current_balance').column))
+        return self.get_query_set().extra(select={'persisted_balance': balance_column})
+    
+    def balances_for(self, accounts):
+        """
+        Take an iterable of ``Account`` model instances (``accounts``) and return a dictionary
+        mapping their IDs to their balances (as signed Decimal numbers).
+        
+        Balances are read from the DB by a single query, since they are persisted along with accounts.
+        """
+        account_ids = [account.pk for account in accounts]
+        persisted = dict(self.get_query_set().filter(pk__in=account_ids).values_list('pk', 'current_balance'))
+        balances = {}
+        for account_id in account_ids:
+            balances[account_id] = persisted.get(account_id) or Decimal(0)
+        return balances
+    
+    def _ledger_balances_for(self, account_ids):
+        # compute the balances of the given accounts from their ledgers, by a single aggregate query 
+        from simple_accounting.models import LedgerEntry
+        entries = LedgerEntry.objects.filter(account__in=account_ids)
+        totals = dict(entries.values_list('account').annotate(total=models.Sum('amount')))
+        balances = {}
+        for account_id in account_ids:
+            balances[account_id] = totals.get(account_id) or Decimal(0)
+        return balances
+    
+    def resolve_paths(self, locations):
+        """
+        Take an iterable of ``(system, path)`` pairs, where ``system`` is an ``AccountSystem`` model instance 
+        and ``path`` is a path string within that system, and return the list of accounts living 
+        at those locations (in the same order).
+        
+        Accounts are retrieved by a single query, no matter how many systems are involved.
+        
+        If no account exists at some of the given locations, raise ``Account.DoesNotExist``, listing 
+        all the missing ones; if a path string is malformed, raise ``MalformedPathString``.
+        """
+        from simple_accounting.models import AccountSystem
+        locations = [(system.pk, path.strip()) for (system, path) in locations]
+        for (system_id, path) in locations:
+            AccountSystem._validate_account_path(path)
+        # fetch a (slight) superset of the requested accounts, then pick the right ones
+        system_ids = set([system_id for (system_id, path) in locations])
+        paths = set([path for (system_id, path) in locations])
+        candidates = self.get_query_set().filter(system__in=system_ids, path__in=paths)
+        accounts = dict([((account.system_id, account.path), account) for account in candidates])
+        missing = [location for location in locations if location not in accounts]
+        if missing:
+            raise self.model.DoesNotExist("No account exists at these locations: %s" % \
+                ", ".join(["%s (system %s)" % (path, system_id) for (system_id, path) in missing]))
+        return [accounts[location] for location in locations]
+    
+    @atomic
+    def reserve_entry_ids(self, account_id, count=1):
+        """
+        Reserve ``count`` consecutive IDs in the ledger of the account having ID ``account_id``, 
+        and return the first of them.
+        
+        IDs are allocated from a per-ledger counter, incremented at the DB level: the ``UPDATE`` 
+        statement locks the account's row until the current DB transaction ends, so concurrent 
+        writers to the same ledger are serialized, and each of them gets a distinct range of IDs. 
+        """
+        accounts = self.get_query_set().filter(pk=account_id)
+        accounts.update(last_entry_id=models.F('last_entry_id') + count)
+        return accounts.values_list('last_entry_id', flat=True)[0] - count + 1
+    
+    def rebuild_balances(self, accounts=None):
+        """
+        Recompute the persisted balance of the given accounts (an iterable of ``Account``
+        model instances) from the entries written to their ledgers, along with the 
+        running balances stored on those entries; if ``accounts`` is not specified, 
+        rebuild the balance of every account.
+        
+        Counters used to allocate IDs in the ledgers (see ``reserve_entry_ids``) 
+        are brought in sync with the entries written to them, too.
+
+        This is meant as a recovery tool, in case persisted balances got out of sync
+        with the ledgers (e.g. after ledger entries have been modified by hand).
+        """
+        from simple_accounting.models import AccountSystem, LedgerEntry
+        if accounts is None:
+            accounts = self.get_query_set()
+        balances = self._ledger_balances_for([account.pk for account in accounts])
+        for (account_id, balance) in balances.items():
+            self.get_query_set().filter(pk=account_id).update(current_balance=balance)
+        account_ids = balances.keys()
+        for system_id in set(self.get_query_set().filter(pk__in=account_ids).values_list('system', flat=True)):
+            AccountSystem.invalidate_total_amount(system_id)
+        # entry counters can't lag behind the IDs already used in the ledgers
+        counters = self.get_query_set().filter(pk__in=account_ids).values_list('pk', 'last_entry_id')
+        for (account_id, last_entry_id, max_entry_id) in counters.annotate(max_entry_id=models.Max('entry_set__entry_id')):
+            if last_entry_id != (max_entry_id or 0):
+                self.get_query_set().filter(pk=account_id).update(last_entry_id=max_entry_id or 0)
+        # replay ledgers in order, fixing running balances stored along with entries
+        entries = LedgerEntry.objects.filter(account__in=account_ids).order_by('account', 'transaction__date', 'entry_id')
+        running_balances = {}
+        for (entry_pk, account_id, amount, balance_after) in entries.values_list('pk', 'account', 'amount', 'balance_after'):
+            running_balances[account_id] = running_balances.get(account_id, 0) + amount
+            if balance_after != running_balances[account_id]:
+                LedgerEntry.objects.filter(pk=entry_pk).update(balance_after=running_balances[account_id])
+
+    def rebuild_paths(self):
+        """
+        Recompute the path stored along with every account from the structure of account trees.
+        
+        This is meant as a recovery tool, e.g. for filling in paths of accounts created 
+        before they were stored in the DB, or after accounts have been modified by hand.
+        """
+        from simple_accounting.consts import ACCOUNT_PATH_SEPARATOR
+        accounts = self.get_query_set().values_list('pk', 'parent', 'name', 'path')
+        children = {}
+        for (account_id, parent_id, name, path) in accounts:
+            children.setdefault(parent_id, []).append((account_id, name, path))
+        # walk account trees top-down, using an explicit stack (trees may be deep) 
+        stack = [(account_id, name, path, ACCOUNT_PATH_SEPARATOR) for (account_id, name, path) in children.get(None, [])]
+        while stack:
+            (account_id, name, path, expected_path) = stack.pop()
+            if path != expected_path:
+                self.get_query_set().filter(pk=account_id).update(path=expected_path)
+            prefix = expected_path.rstrip(ACCOUNT_PATH_SEPARATOR) + ACCOUNT_PATH_SEPARATOR
+            for (child_id, child_name, child_path) in children.get(account_id, []):
+                stack.append((child_id, child_name, child_path, prefix + child_name))
+
+    def take_balance_snapshots(self, period_end, accounts=None):
+        """
+        Take a snapshot of the balance of the given accounts (an iterable of ``Account``
+        model instances) at date ``period_end``; if ``accounts`` is not specified,
+        take a snapshot for every account.
+
+        Only transactions happened *before* ``period_end`` contribute to snapshotted balances.
+        Existing snapshots for the same period are refreshed, while new ones 
+        are inserted by a single multi-row statement.
+        """
+        from simple_accounting.models import LedgerEntry, BalanceSnapshot
+        if accounts is None:
+            accounts = self.get_query_set()
+        account_ids = [account.pk for account in accounts]
+        # sum up ledger entries by account, using a single aggregate query
+        entries = LedgerEntry.objects.filter(account__in=account_ids, transaction__date__lt=period_end)
+        totals = dict(entries.values_list('account').annotate(total=models.Sum('amount')))
+        existing_snapshots = BalanceSnapshot.objects.filter(account__in=account_ids, period_end=period_end)
+        already_snapshotted = set(existing_snapshots.values_list('account', flat=True))
+        new_snapshots = []
+        for account_id in account_ids:
+            balance = totals.get(account_id) or 0
+            if account_id in already_snapshotted:
+                existing_snapshots.filter(account=account_id).update(balance=balance)
+            else:
+                new_snapshots.append(BalanceSnapshot(account_id=account_id, period_end=period_end, balance=balance))
+        bulk_insert(BalanceSnapshot, new_snapshots)
 
 
 class TransactionManager(models.Manager):
@@ -49,4 +266,151 @@ class TransactionManager(models.Manager):
             transactions &= set([tref.transaction for tref in trefs])        
         if transactions:
             queryset_from_iterable(self.model, transactions)
-        return qs
\ No newline at end of file
+        return qs
+
+class LedgerEntryManager(models.Manager):
+    """
+    A custom manager class for the ``LedgerEntry`` model.
+    """
+    @atomic
+    def write_entries(self, entries):
+        """
+        Take a list of (unsaved) ``LedgerEntry`` model instances and write them to the ledgers
+        of their accounts, with the same outcome as saving them one at a time, but much faster:
+        * entries are inserted by a single multi-row statement 
+        * the persisted balance of each account involved is updated once
+        * running balances of entries are computed in memory, based on the state of the ledger 
+          retrieved by a single query; only ledgers receiving back-dated entries 
+          need further queries
+        
+        Ledger entries' transactions must have already been saved; IDs in the ledgers are allocated 
+        as by ``Account.objects.reserve_entry_ids``.
+        """
+        from simple_accounting.models import Account, AccountSystem, BalanceSnapshot
+        if not entries:
+            return
+        amount_field = self.model._meta.get_field('amount')
+        entries_by_account = {}
+        for entry in entries:
+            # model validation is skipped, but amounts must be converted as it would do (e.g. from floats) 
+            entry.amount = amount_field.to_python(entry.amount)
+            entries_by_account.setdefault(entry.account_id, []).append(entry)
+        # (accounts are processed in a fixed order, so that concurrent writers lock them in the same order) 
+        account_ids = sorted(entries_by_account.keys())
+        # update the persisted balance of each account involved, reserving a range of IDs 
+        # in its ledger by the same statement
+        for account_id in account_ids:
+            account_entries = entries_by_account[account_id]
+            Account.objects.filter(pk=account_id).update(current_balance=models.F('current_balance') + sum([entry.amount for entry in account_entries]), 
+                                                         last_entry_id=models.F('last_entry_id') + len(account_entries))
+        # retrieve the state of every ledger involved, by a single query
+        ledgers = Account.objects.filter(pk__in=account_ids).values_list('pk', 'system', 'current_balance', 'last_entry_id')
+        ledgers = ledgers.annotate(last_date=models.Max('entry_set__transaction__date'))
+        system_ids = set()
+        for (account_id, system_id, current_balance, last_entry_id, last_date) in ledgers:
+            system_ids.add(system_id)
+            account_entries = entries_by_account[account_id]
+            # set IDs in the ledger, in order of writing 
+            first_entry_id = last_entry_id - len(account_entries) + 1
+            for (i, entry) in enumerate(account_entries):
+                entry.entry_id = first_entry_id + i
+            account_entries = sorted(account_entries, key=lambda entry: (entry.transaction.date, entry.entry_id))
+            first_date = account_entries[0].transaction.date
+            if last_date is None or first_date >= last_date:
+                # entries are appended to the ledger, so running balances start from 
+                # the balance the account had before them
+                balance = current_balance - sum([entry.amount for entry in account_entries])
+                for entry in account_entries:
+                    balance += entry.amount
+                    entry.balance_after = balance
+            else:
+                self._write_back_dated_entries(account_id, account_entries)
+        bulk_insert(self.model, entries)
+        # update balance snapshots covering written entries 
+        first_date = min([entry.transaction.date for entry in entries])
+        snapshots = BalanceSnapshot.objects.filter(account__in=account_ids, period_end__gt=first_date)
+        for (snapshot_id, account_id, period_end) in snapshots.values_list('pk', 'account', 'period_end'):
+            delta = sum([entry.amount for entry in entries_by_account[account_id] if entry.transaction.date < period_end])
+            if delta:
+                BalanceSnapshot.objects.filter(pk=snapshot_id).update(balance=models.F('balance') + delta)
+        for system_id in system_ids:
+            AccountSystem.invalidate_total_amount(system_id)
+    
+    def _write_back_dated_entries(self, account_id, account_entries):
+        # compute running balances for (some) entries written before the last one in the ledger,
+        # and shift running balances of existing entries written after them;
+        # ``account_entries`` must be sorted by date and ID in the ledger 
+        first_date = account_entries[0].transaction.date
+        ledger = self.get_query_set().filter(account=account_id)
+        try:
+            base_balance = ledger.filter(transaction__date__lt=first_date).order_by('-transaction__date', '-entry_id').values_list('balance_after', flat=True)[0]
+        except IndexError:
+            base_balance = 0
+        existing_entries = list(ledger.filter(transaction__date__gte=first_date).order_by('transaction__date', 'entry_id').values_list('transaction__date', 'balance_after'))
+        written = 0
+        for entry in account_entries:
+            # the running balance of the last existing entry preceding this one
+            balance = base_balance
+            for (date, balance_after) in existing_entries:
+                if date > entry.transaction.date:
+                    break
+                balance = balance_after
+            written += entry.amount
+            entry.balance_after = balance + written
+            ledger.filter(transaction__date__gt=entry.transaction.date).update(balance_after=models.F('balance_after') + entry.amount)
+
+
+class LedgerAggregateManager(models.Manager):
+    """
+    A custom manager class for the ``LedgerAggregate`` model.
+    """
+    @atomic
+    def refresh(self):
+        """
+        Bring ledger aggregates up-to-date, processing only those ledger entries 
+        which haven't been aggregated yet.
+        
+        Everything happens within a single DB transaction, and entries are claimed 
+        (i.e. flagged as aggregated) before aggregates are updated: if another refresh 
+        has claimed some of them in the meantime, raise ``InvalidAccountingOperation`` 
+        (rolling back), so that no entry is ever counted twice.
+        """
+        from simple_accounting.models import LedgerEntry
+        from simple_accounting.exceptions import InvalidAccountingOperation
+        new_entries = LedgerEntry.objects.filter(is_aggregated=False)
+        new_entries = list(new_entries.values_list('pk', 'account', 'transaction__date', 'transaction__kind', 'amount'))
+        # claim new entries (in chunks, to keep the size of queries bounded); the ``UPDATE`` statement 
+        # locks them until the end of the transaction, so a concurrent refresh can't claim them, too 
+        entry_pks = [entry[0] for entry in new_entries]
+        for i in range(0, len(entry_pks), 500):
+            chunk = entry_pks[i:i+500]
+            if LedgerEntry.objects.filter(pk__in=chunk, is_aggregated=False).update(is_aggregated=True) != len(chunk):
+                raise InvalidAccountingOperation("Ledger aggregates are being refreshed by another process")
+        # accumulate new entries by bucket, in memory
+        buckets = {}
+        for (entry_pk, account_id, date, kind, amount) in new_entries:
+            for granularity in (self.model.DAY, self.model.MONTH):
+                bucket = (account_id, granularity, self.model.get_period_start(date, granularity), kind or '')
+                (total, count) = buckets.get(bucket, (0, 0))
+                buckets[bucket] = (total + amount, count + 1)
+        for ((account_id, granularity, period_start, kind), (total, count)) in buckets.items():
+            self._update_bucket(account_id, granularity, period_start, kind, total, count)
+
+    def revert_entry(self, entry):
+        """
+        Revert the effect of ledger entry ``entry`` on aggregates (e.g. when it's going to be deleted).
+        
+        If ``entry`` has not been aggregated yet, do nothing.
+        """
+        from simple_accounting.models import LedgerEntry
+        # the ``is_aggregated`` flag of the given instance may be stale, so ask the DB 
+        if LedgerEntry.objects.filter(pk=entry.pk, is_aggregated=True).exists():
+            for granularity in (self.model.DAY, self.model.MONTH):
+                period_start = self.model.get_period_start(entry.date, granularity)
+                self._update_bucket(entry.account_id, granularity, period_start, entry.transaction.kind or '', -entry.amount, -1)
+
+    def _update_bucket(self, account_id, granularity, period_start, kind, total, count):
+        bucket = self.get_query_set().filter(account=account_id, granularity=granularity, period_start=period_start, transaction_kind=kind)
+        updated = bucket.update(total=models.F('total') + total, count=models.F('count') + count)
+        if not updated:
+            self.create(account_id=account_id, granularity=granularity, period_start=period_start, transaction_kind=kind, total=total, count=count)
@@ -15,21 +15,25 @@
 # along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf import settings 
-from django.db import models
-from django.db.models.signals import post_save, post_delete
+from django.db import models, transaction, connections, router, IntegrityError
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.core.exceptions import ValidationError
+from django.core.cache import cache
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 
-from simple_accounting.consts import ACCOUNT_PATH_SEPARATOR
+from simple_accounting.consts import ACCOUNT_PATH_SEPARATOR, ACCOUNTING_CACHE_TOTAL_AMOUNT, ACCOUNTING_CACHE_ACCOUNT_TREES
+from simple_accounting.consts import ACCOUNTING_CACHE_TOTAL_AMOUNT_TIMEOUT
 from simple_accounting.fields import CurrencyField
-from simple_accounting.managers import AccountManager, TransactionManager
+from simple_accounting.lib import bulk_insert, atomic, on_commit
+from simple_accounting.managers import AccountSystemManager, AccountManager, TransactionManager, LedgerEntryManager, LedgerAggregateManager
 from simple_accounting.exceptions import MalformedAccountTree, SubjectiveAPIError, InvalidAccountingOperation, MalformedPathString
 
 from datetime import datetime
+from decimal import Decimal
 
 
 class Subject(models.Model):
@@ -78,8 +82,10 @@ class Subject(models.Model):
         # create a root account
         system.add_root_account()
         # create root accounts for incomes and expenses
-        system.add_account(parent_path=system.root.path, name='incomes', kind=account_type.income)
-        system.add_account(parent_path=system.root.path, name='expenses', kind=account_type.expense)
+        system.build_tree({
+            'incomes': {'kind': account_type.income},
+            'expenses': {'kind': account_type.expense},
+        })
         
 
 class SubjectDescriptor(object):
@@ -152,6 +158,9 @@ def economic_subject(cls):
         if created:
             ct = ContentType.objects.get_for_model(sender)
             Subject.objects.create(content_type=ct, object_id=instance.pk)
+            # now accounting-related setup tasks can be performed, if any
+            if getattr(instance, 'setup_accounting', None):     
+                instance.setup_accounting()
             
     # clean-up dangling subjects after a subjective model instance is deleted from the DB
     @receiver(post_delete, sender=model, weak=False)
@@ -170,7 +179,10 @@ def economic_subject(cls):
 # implementing a ``.setup_accounting()`` method.
 @receiver(post_save)
 def setup_accounting(sender, instance, created, **kwargs):
-    if created:
+    from simple_accounting import subjective_models
+    # subjective models are setup as soon as their subject has been created (see ``economic_subject``),
+    # since this receiver may be called before that happens
+    if created and sender not in subjective_models:
     # call the ``.setup_accounting()`` method on the sender model, if defined
         if getattr(instance, 'setup_accounting', None):     
             instance.setup_accounting()
@@ -305,6 +317,20 @@ class BasicAccountType(object):
 account_type = BasicAccountType()
 
    
+# characters having a special meaning within regular expressions
+_REGEX_METACHARACTERS = frozenset('\\.^$*+?{}[]|()-')
+
+def _escape_regex(text):
+    # unlike ``re.escape()``, only escape actual metacharacters: escaped letters 
+    # (e.g. non-ASCII ones) are rejected by some DB backends (e.g. PostgreSQL)
+    escaped = ''
+    for char in text:
+        if char in _REGEX_METACHARACTERS:
+            escaped += '\\'
+        escaped += char
+    return escaped
+
+
 class AccountSystem(models.Model):
     """
     A double-entry accounting system.
@@ -320,20 +346,35 @@ class AccountSystem(models.Model):
     """
     # the subject operating this accounting system
     owner = models.OneToOneField(Subject, related_name='account_system')
+    
+    objects = AccountSystemManager()
 
     # the root account of this system
     @property
     def root(self):
         # caching
         if not getattr(self,'_root', None):
-            for account in self.accounts:
-                if account.is_root: 
-                    self._root = account
-                    return self._root
-            # if we arrived here, no root account was created for this accounting system !
-            raise MalformedAccountTree(ugettext(u"No root account was created for this account system: %s") % self)
+            self._root = self.get_root(self.pk)
         return self._root
     
+    @staticmethod
+    def get_root(system_id):
+        """
+        Return the root account of the accounting system with ID ``system_id``.
+        
+        The root account is retrieved by a single indexed query (or from the cached account tree,
+        if the ``ACCOUNTING_CACHE_ACCOUNT_TREES`` setting is enabled).
+        
+        If no root account exists for that system, raise ``MalformedAccountTree``.
+        """
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return AccountTree.for_system(system_id).root
+        try:
+            # the root account is the only one living at path ``ACCOUNT_PATH_SEPARATOR`` 
+            return Account.objects.get(system=system_id, path=ACCOUNT_PATH_SEPARATOR)
+        except Account.DoesNotExist:
+            raise MalformedAccountTree(ugettext(u"No root account was created for the account system with ID %s") % system_id)
+    
     @property
     def accounts(self):
         """
@@ -347,13 +388,114 @@ class AccountSystem(models.Model):
         Calculate the total amount of money stored in this accounting system,
         as an algebraic sum of the balances of all stock-like accounts 
         belonging to it. 
-        """
-        total_amount = 0
-        for account in self.accounts:
-            # skip flux-like accounts, since they don't actually contain money
-            if account.is_stock:
-                total_amount += account.balance
+        
+        The total is computed by a single aggregate query; if the 
+        ``ACCOUNTING_CACHE_TOTAL_AMOUNT`` setting is enabled, it's also cached 
+        until a ledger entry is written to (or deleted from) this system, or for
+        ``ACCOUNTING_CACHE_TOTAL_AMOUNT_TIMEOUT`` seconds, whichever comes first.
+        """
+        if ACCOUNTING_CACHE_TOTAL_AMOUNT:
+            total_amount = cache.get(self.total_amount_cache_key(self.pk))
+            if total_amount is not None:
+                return total_amount
+        # skip flux-like accounts, since they don't actually contain money
+        stock_accounts = self.accounts.filter(kind__base_type__in=(AccountType.ASSET, AccountType.LIABILITY))
+        total_amount = stock_accounts.aggregate(total=models.Sum('current_balance'))['total'] or Decimal(0)
+        if ACCOUNTING_CACHE_TOTAL_AMOUNT:
+            cache.set(self.total_amount_cache_key(self.pk), total_amount, ACCOUNTING_CACHE_TOTAL_AMOUNT_TIMEOUT)
         return total_amount
+    
+    @staticmethod
+    def total_amount_cache_key(system_id):
+        return 'simple_accounting:total_amount:%s' % system_id
+    
+    @classmethod
+    def invalidate_total_amount(cls, system_id):
+        """
+        Invalidate the cached total amount of money stored 
+        in the accounting system with ID ``system_id`` (if any).  
+        
+        Within an ``atomic`` block, the cached value is deleted once the block has committed;
+        otherwise, a concurrent reader could cache the old total in the meantime. 
+        """
+        if ACCOUNTING_CACHE_TOTAL_AMOUNT:
+            cache_key = cls.total_amount_cache_key(system_id)
+            on_commit(lambda: cache.delete(cache_key))
+
+    def ledger_aggregates(self, granularity, start=None, end=None):
+        """
+        Return the queryset of ledger aggregates (see ``LedgerAggregate``) of the given ``granularity`` 
+        for the accounts belonging to this system, ordered by period; if ``start`` (``end``) is specified, 
+        only periods starting on or after (before) that date are included.
+        
+        Note that aggregates are refreshed incrementally, so they only reflect ledger entries
+        written up to the last refresh.  
+        """
+        aggregates = LedgerAggregate.objects.filter(account__system=self, granularity=granularity)
+        if start:
+            aggregates = aggregates.filter(period_start__gte=start)
+        if end:
+            aggregates = aggregates.filter(period_start__lt=end)
+        return aggregates.order_by('period_start', 'account', 'transaction_kind')
+    
+    def walk(self, with_balances=False):
+        """
+        Walk the tree of accounts belonging to this system, depth-first, yielding 
+        a 2-tuple ``(depth, account)`` for each account (the root account having depth 0); 
+        children of an account are visited in alphabetical order.
+        
+        The whole tree is retrieved by a single query, no matter how deep it is; 
+        if ``with_balances`` is ``True``, balances are retrieved along with accounts
+        (see ``AccountManager.with_balances()``), so that accessing the ``.balance`` 
+        property of yielded accounts doesn't hit the DB.
+        """
+        if with_balances:
+            accounts = Account.objects.with_balances().filter(system=self)
+        else:
+            accounts = self.accounts
+        children = {}
+        for account in accounts.order_by('name'):
+            children.setdefault(account.parent_id, []).append(account)
+        # use an explicit stack, so that deep trees don't hit the recursion limit 
+        stack = [(0, root) for root in reversed(children.get(None, []))]
+        while stack:
+            (depth, account) = stack.pop()
+            yield (depth, account)
+            stack.extend([(depth + 1, child) for child in reversed(children.get(account.pk, []))])
+    
+    def rollup_balances(self):
+        """
+        Return a dictionary mapping the path of every account belonging to this system
+        to a 2-tuple ``(balance, subtree_balance)``, where:
+        * ``balance`` is the balance of the account itself
+        * ``subtree_balance`` is the algebraic sum of the balances of that account
+          and of all its descendants
+
+        This is mostly useful for placeholder accounts, which have no balance of their own.
+
+        The whole account tree (along with balances) is retrieved by a single query,
+        no matter how deep it is.
+        """
+        accounts = Account.objects.with_balances().filter(system=self)
+        children = {}
+        for account in accounts:
+            children.setdefault(account.parent_id, []).append(account)
+        # visit the tree depth-first, using an explicit stack (so that deep trees 
+        # don't hit the recursion limit); every account is visited before its descendants 
+        visited = []
+        stack = list(children.get(None, []))
+        while stack:
+            account = stack.pop()
+            visited.append(account)
+            stack.extend(children.get(account.pk, []))
+        # then sum up balances bottom-up, so subtrees are summed up before their parents
+        subtree_balances = {}
+        rv = {}
+        for account in reversed(visited):
+            subtree_balance = account.balance + sum([subtree_balances[child.pk] for child in children.get(account.pk, [])])
+            subtree_balances[account.pk] = subtree_balance
+            rv[account.path] = (account.balance, subtree_balance)
+        return rv
 
     def __unicode__(self):
         return ugettext(u"Accounting system for %(subject)s") % {'subject': self.owner}
@@ -379,6 +521,78 @@ class AccountSystem(models.Model):
         account = self.get_account_from_path(path)
         return account
      
+    def __contains__(self, path):
+        """
+        Return ``True`` if an account exists at location ``path`` within this system, ``False`` otherwise
+        (this includes the case of malformed path strings).
+        """
+        try:
+            self.get_account_from_path(path)
+        except (Account.DoesNotExist, MalformedPathString):
+            return False
+        return True
+    
+    def __iter__(self):
+        """
+        Iterate over the paths of the accounts belonging to this system.
+        """
+        return iter(self.keys())
+    
+    def __len__(self):
+        """
+        Return the number of accounts belonging to this system.
+        """
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return len(AccountTree.for_system(self.pk).accounts)
+        return self.accounts.count()
+    
+    def __nonzero__(self):
+        # since ``__len__`` is defined, an explicit truth test is needed,
+        # otherwise evaluating an accounting system in a boolean context would hit the DB 
+        return True
+    
+    def get(self, path, default=None):
+        """
+        Return the account living at location ``path`` within this system, if any; 
+        ``default`` otherwise.
+        
+        If ``path`` is an invalid string representation of a path in a tree of accounts,
+        raise ``MalformedPathString``.
+        """
+        try:
+            return self.get_account_from_path(path)
+        except Account.DoesNotExist:
+            return default
+    
+    def keys(self):
+        """
+        Return the (sorted) list of paths of the accounts belonging to this system.
+        
+        Paths are retrieved by a single query (or from the cached account tree, 
+        if the ``ACCOUNTING_CACHE_ACCOUNT_TREES`` setting is enabled).
+        """
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return sorted(AccountTree.for_system(self.pk).accounts.keys())
+        return list(self.accounts.order_by('path').values_list('path', flat=True))
+    
+    def values(self):
+        """
+        Return the list of accounts belonging to this system, sorted by path.
+        """
+        return [account for (path, account) in self.items()]
+    
+    def items(self):
+        """
+        Return the list of accounts belonging to this system, as ``(path, account)`` pairs
+        sorted by path. 
+        
+        Accounts are retrieved by a single query (or from the cached account tree, 
+        if the ``ACCOUNTING_CACHE_ACCOUNT_TREES`` setting is enabled).
+        """
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return sorted(AccountTree.for_system(self.pk).accounts.items(), key=lambda item: item[0])
+        return [(account.path, account) for account in self.accounts.order_by('path')]
+    
     @staticmethod
     def _validate_account_path(path):
         import re
@@ -407,25 +621,56 @@ class AccountSystem(models.Model):
         """
         path = path.strip() # strip leading and trailing whitespaces
         self._validate_account_path(path)
-        # normalize paths so they end with ``ACCOUNT_PATH_SEPARATOR``
-        if not path.endswith(ACCOUNT_PATH_SEPARATOR):
-            path += ACCOUNT_PATH_SEPARATOR
-        # split path components
-        path_components = path.split(ACCOUNT_PATH_SEPARATOR)
-        path_components = path_components[1:] # strip initial '' component
-        # corner case       
-        if len(path_components) == 1: # i.e. path == '/'
-            return self.root  
-        else:
-            account = self.root
-            while True:
-                if len(path_components) == 1: # end recursion
-                    return account
-                else:
-                    account = account.get_child(path_components[0])
-                    path_components = path_components[1:]
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return AccountTree.for_system(self.pk).get_account(path)
+        # paths are materialized on accounts, so a single (indexed) lookup is enough 
+        return Account.objects.get(system=self, path=path)
 
             
+    def find(self, pattern):
+        """
+        Return the queryset of accounts belonging to this system whose path matches 
+        the glob-like pattern ``pattern``; within patterns, ``*`` stands for any 
+        (possibly empty) sequence of characters within a path component, while ``?`` 
+        stands for a single character within a path component.  
+        
+        For example, ``system.find('/members/*')`` returns every child of the ``/members`` account,
+        while ``system.find('/expenses/gas/*/fees')`` returns the ``fees`` accounts of every GAS.
+        
+        Matching accounts are retrieved by a single query, restricted by the (indexed) 
+        path prefix preceding the first wildcard.
+        
+        If ``pattern`` isn't a valid path string, raise ``MalformedPathString``.
+        """
+        import re
+        
+        pattern = pattern.strip()
+        self._validate_account_path(pattern)
+        wildcards = re.search(r'[*?]', pattern)
+        if not wildcards:
+            return self.accounts.filter(path=pattern)
+        component_char = '[^%s]' % _escape_regex(ACCOUNT_PATH_SEPARATOR)
+        regex = ''
+        for char in pattern:
+            if char == '*':
+                regex += component_char + '*'
+            elif char == '?':
+                regex += component_char
+            else:
+                regex += _escape_regex(char)
+        # the path of the root account (``/``) would match ``/*``, but the root has no name to match 
+        return self.accounts.filter(parent__isnull=False, path__startswith=pattern[:wildcards.start()], path__regex='^%s$' % regex)
+    
+    def find_balance(self, pattern):
+        """
+        Return the total balance of the accounts belonging to this system whose path matches 
+        the glob-like pattern ``pattern`` (see ``.find()`` for details about pattern syntax), 
+        as a signed Decimal number.
+        
+        The total is computed by a single aggregate query.
+        """
+        return self.find(pattern).aggregate(total=models.Sum('current_balance'))['total'] or Decimal(0)
+    
     def add_account(self, parent_path, name, kind, is_placeholder=False):
         """
         Add an account to this accounting system, based on given specifications.
@@ -448,6 +693,99 @@ class AccountSystem(models.Model):
         """
         Account.objects.create(system=self, parent=self[parent_path], name=name, kind=kind, is_placeholder=is_placeholder)
     
+    @atomic
+    def build_tree(self, spec, parent_path=ACCOUNT_PATH_SEPARATOR):
+        """
+        Add a whole tree of accounts to this accounting system, below the account living 
+        at location ``parent_path`` (by default, the root account).
+        
+        ``spec`` is a dictionary mapping names of the accounts to be added to dictionaries 
+        describing them, by these (optional) keys:
+        ``kind``
+            the type of the account (as an ``AccountType`` model instance); 
+            if not specified, assume that of its parent (required for children of the root account)
+        ``is_placeholder``
+            A boolean flag specifying if the account is to be considered a placeholder (default: ``False``)
+        ``children``
+            a specification (in the same format) for the children of the account
+        
+        If an account already exists at a given location, it's left untouched, while its 
+        children (if any) are added; this way, accounts may be added below existing ones.     
+        
+        The whole specification is validated in memory before writing anything; if it's not 
+        compliant with the rules enforced by ``Account`` model validation, raise ``MalformedAccountTree``.  
+        New accounts are then inserted level by level, by a single multi-row statement for each level.
+        
+        If the given path location is invalid (see ``__getitem__``'s docstring fo details), raise ``MalformedPathString``;
+        if no account exists at that location, raise ``Account.DoesNotExist``.
+        """
+        parent_path = parent_path.strip()
+        self._validate_account_path(parent_path)
+        # retrieve the subtree rooted at the parent account (along with account types) by a single query 
+        subtree = self.accounts.select_related('kind')
+        if parent_path != ACCOUNT_PATH_SEPARATOR:
+            subtree = subtree.filter(models.Q(path=parent_path) | models.Q(path__startswith=parent_path + ACCOUNT_PATH_SEPARATOR))
+        existing_accounts = dict([(account.path, account) for account in subtree])
+        try:
+            parent = existing_accounts[parent_path]
+        except KeyError:
+            raise Account.DoesNotExist(ugettext(u"No account exists at this location: %s") % parent_path)
+        # validate the specification, collecting new accounts by tree level
+        levels = []
+        self._plan_tree(spec, parent, existing_accounts, levels)
+        for level in levels:
+            # parents created at the previous level have been assigned an ID by now
+            for account in level:
+                account.parent_id = account.parent.pk
+            bulk_insert(Account, level)
+            # retrieve IDs of accounts just created (in chunks, to keep the size of queries bounded)
+            accounts_by_path = dict([(account.path, account) for account in level])
+            paths = accounts_by_path.keys()
+            for i in range(0, len(paths), 500):
+                for (path, account_id) in self.accounts.filter(path__in=paths[i:i+500]).values_list('path', 'pk'):
+                    accounts_by_path[path].pk = account_id
+        # since no signals were sent, invalidate the cached account tree by hand
+        if levels and ACCOUNTING_CACHE_ACCOUNT_TREES:
+            AccountTree.invalidate(self.pk)
+    
+    def _plan_tree(self, spec, parent, existing_accounts, levels, depth=0):
+        # validate the tree specification ``spec`` for the children of account ``parent``, 
+        # adding the (unsaved) accounts to be created to ``levels`` 
+        parent_is_root = (parent.path == ACCOUNT_PATH_SEPARATOR)
+        for (name, node) in spec.items():
+            if name == '':
+                raise MalformedAccountTree(ugettext(u"Only root accounts can have an empty name"))
+            if ACCOUNT_PATH_SEPARATOR in name:
+                raise MalformedAccountTree(ugettext(u"Account names can't contain %s") % ACCOUNT_PATH_SEPARATOR)
+            if parent_is_root:
+                path = ACCOUNT_PATH_SEPARATOR + name
+            else:
+                path = parent.path + ACCOUNT_PATH_SEPARATOR + name
+            account = existing_accounts.get(path)
+            if account is None:
+                kind = node.get('kind')
+                if kind is None:
+                    # the type of the root account isn't a valid one for other accounts
+                    if parent_is_root:
+                        raise MalformedAccountTree(ugettext(u"Children of the root account must specify their type: %s") % path)
+                    kind = parent.kind
+                if kind.is_stock and not (parent.kind.is_stock or parent_is_root):
+                    raise MalformedAccountTree(ugettext(u"A stock-like account's parent must be a stock-like account (or the root account): %s") % path)
+                if kind.is_flux and not (parent.kind.is_flux or parent_is_root):
+                    raise MalformedAccountTree(ugettext(u"A flux-like account's parent must be a flux-like account (or the root account): %s") % path)
+                if len(path) > Account._meta.get_field('path').max_length:
+                    raise MalformedAccountTree(ugettext(u"Account path is too long: %s") % path)
+                account = Account(system=self, parent=parent, name=name, kind=kind, is_placeholder=node.get('is_placeholder', False), path=path)
+                # check field values (e.g. the length of the name), skipping checks requiring queries 
+                try:
+                    account.clean_fields(exclude=['system', 'parent', 'kind'])
+                except ValidationError, e:
+                    raise MalformedAccountTree(ugettext(u"Account %(path)s is invalid: %(errors)s") % {'path': path, 'errors': ' '.join(e.messages)})
+                while len(levels) <= depth:
+                    levels.append([])
+                levels[depth].append(account)
+            self._plan_tree(node.get('children', {}), account, existing_accounts, levels, depth + 1)
+            
     def add_root_account(self):
         """
         Create a root account for this system.
@@ -479,6 +817,16 @@ class Account(models.Model):
     name = models.CharField(max_length=128, blank=True)
     kind = models.ForeignKey(AccountType, related_name='account_set')
     is_placeholder = models.BooleanField(default=False)
+    # the current balance of this account; it's kept up-to-date 
+    # as entries are written to (or deleted from) the ledger
+    current_balance = CurrencyField(default=0, editable=False)
+    # the tree path needed to reach this account from the root of the accounting system,
+    # as a string of components separated by the ``ACCOUNT_PATH_SEPARATOR`` character(s);
+    # it's kept up-to-date as the account tree changes, so paths can be looked up by a single query 
+    path = models.CharField(max_length=255, editable=False)
+    # the ID of the last entry written to this account's ledger; it's a per-ledger counter, 
+    # incremented at the DB level as IDs are allocated to new entries 
+    last_entry_id = models.PositiveIntegerField(default=0, editable=False)
     
     objects = AccountManager()
     
@@ -516,38 +864,80 @@ class Account(models.Model):
     def balance(self):
         """
         The money balance of this account (as a signed Decimal number).
+        
+        Since the balance is persisted along with the account, reading it doesn't 
+        require to scan the ledger; the value is always read fresh from the DB,
+        so it reflects ledger entries written after this instance was loaded.
+        
+        If this account has been retrieved along with its balance 
+        (see ``AccountManager.with_balances()``), no query is performed at all. 
         """
-        if not getattr(self, '_balance', None):
-            balance = 0
-            for entry in self.ledger_entries:
-                balance += entry.amount
-            self._balance = balance
-        return self._balance
+        if hasattr(self, 'persisted_balance'):
+            return self.persisted_balance
+        return Account.objects.filter(pk=self.pk).values_list('current_balance', flat=True)[0]
     
-    @property
-    def path(self):
+    def balance_at(self, date):
         """
-        The tree path needed to reach this account from the root of the accounting system,
-        as a string of components separated by the ``ACCOUNT_PATH_SEPARATOR`` character(s).
+        The money balance of this account at a given date (as a signed Decimal number),
+        i.e. only taking into account transactions happened up to that date (included).
+        
+        If a balance snapshot was taken for this account before that date, start from 
+        the nearest one, and just sum up ledger entries written after it; otherwise, 
+        read the running balance of the last ledger entry up to that date.
         """
-        if self.is_root: # stop recursion
+        try:
+            snapshot = self.snapshot_set.filter(period_end__lte=date).order_by('-period_end')[0]
+        except IndexError:
+            entries = self.entry_set.filter(transaction__date__lte=date).order_by('-transaction__date', '-entry_id')
+            try:
+                return entries.values_list('balance_after', flat=True)[0]
+            except IndexError:
+                return 0
+        entries = self.entry_set.filter(transaction__date__gte=snapshot.period_end, transaction__date__lte=date)
+        return snapshot.balance + (entries.aggregate(total=models.Sum('amount'))['total'] or 0)
+    
+    def ledger_aggregates(self, granularity, start=None, end=None):
+        """
+        Return the queryset of ledger aggregates (see ``LedgerAggregate``) of the given ``granularity`` 
+        for this account, ordered by period; if ``start`` (``end``) is specified, only periods 
+        starting on or after (before) that date are included.
+        
+        Note that aggregates are refreshed incrementally, so they only reflect ledger entries
+        written up to the last refresh.  
+        """
+        aggregates = self.aggregate_set.filter(granularity=granularity)
+        if start:
+            aggregates = aggregates.filter(period_start__gte=start)
+        if end:
+            aggregates = aggregates.filter(period_start__lt=end)
+        return aggregates.order_by('period_start', 'transaction_kind')
+    
+    def _get_path_from_parent(self):
+        """
+        Compute the path of this account from that of its parent.
+        """
+        if self.is_root:
             return ACCOUNT_PATH_SEPARATOR
-        path = Account.path(self.parent) + ACCOUNT_PATH_SEPARATOR + self.name # recursion
-        return path 
+        if self.parent.is_root:
+            return ACCOUNT_PATH_SEPARATOR + self.name
+        return self.parent.path + ACCOUNT_PATH_SEPARATOR + self.name
     
     @property
     def is_root(self):
         """
         Return ``True`` if this account is a root one, ``False`` otherwise.
         """
-        return not self.parent
+        # don't fetch the parent account just for checking if it's there
+        return self.parent_id is None
     
     @property
     def root(self):
         """
         The root account of the accounting system this account belongs to.
         """
-        return self.system.root
+        if self.is_root:
+            return self
+        return AccountSystem.get_root(self.system_id)
     
     @property
     def ledger_entries(self):
@@ -564,7 +954,7 @@ class Account(models.Model):
         ## check that this account belongs to the same accounting system of its parent (if any)
         if self.parent:
             try:
-                assert self.system == self.parent.system
+                assert self.system_id == self.parent.system_id
             except AssertionError:
                 raise ValidationError(ugettext(u"This account and its parent belong to different accounting systems."))
         ## check that stock-like accounts (assets, liabilities) are not mixed with flux-like ones (incomes, expenses)
@@ -596,11 +986,60 @@ class Account(models.Model):
         ## account names can't contain ``ACCOUNT_PATH_SEPARATOR``
         if ACCOUNT_PATH_SEPARATOR in self.name:
             raise ValidationError(ugettext(u"Account names can't contain %s") % ACCOUNT_PATH_SEPARATOR)
+        
+        ## the path of this account must fit into the DB column where it's stored
+        max_path_length = self._meta.get_field('path').max_length
+        if len(self._get_path_from_parent()) > max_path_length:
+            raise ValidationError(ugettext(u"An account's path can't be longer than %d characters") % max_path_length)
                 
     def save(self, *args, **kwargs):
+        # the persisted balance (along with the entry counter) is only modified by the ledger machinery,
+        # so make sure to not overwrite it with a (possibly) stale value
+        old_path = None
+        if self.pk:
+            persisted = Account.objects.filter(pk=self.pk).values_list('current_balance', 'last_entry_id', 'path')
+            if persisted:
+                (self.current_balance, self.last_entry_id, old_path) = persisted[0]
+        # keep the materialized path in sync with the position of this account within the tree
+        self.path = self._get_path_from_parent()
         # perform model validation
         self.full_clean()
+        renamed = old_path and old_path != self.path
+        if renamed:
+            self._check_descendant_paths(old_path)
         super(Account, self).save(*args, **kwargs)
+        # if this account has been renamed (or moved), fix the paths of its descendants, too 
+        if renamed:
+            self._update_descendant_paths(old_path)
+    
+    def _check_descendant_paths(self, old_path):
+        # paths of descendants are rewritten by a raw UPDATE statement, bypassing model validation,
+        # so make sure that they still fit into the DB column before touching anything
+        max_path_length = self._meta.get_field('path').max_length
+        descendant_paths = Account.objects.filter(system=self.system_id, path__startswith=old_path + ACCOUNT_PATH_SEPARATOR).values_list('path', flat=True)
+        longest = max([len(path) for path in descendant_paths] or [0])
+        if longest and longest - len(old_path) + len(self.path) > max_path_length:
+            raise ValidationError(ugettext(u"An account's path can't be longer than %d characters") % max_path_length)
+    
+    def _update_descendant_paths(self, old_path):
+        # replace ``old_path`` with the current path of this account, as a prefix of descendants' paths;
+        # this is done by a single UPDATE statement, but string concatenation isn't portable
+        # across DB backends, so raw SQL is needed  
+        using = router.db_for_write(Account)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        if connection.vendor == 'mysql':
+            new_path_sql = "CONCAT(%%s, SUBSTR(%(path)s, %%s))"
+        else:
+            new_path_sql = "%%s || SUBSTR(%(path)s, %%s)"
+        sql = ("UPDATE %(table)s SET %(path)s = " + new_path_sql + " WHERE %(system)s = %%s AND SUBSTR(%(path)s, 1, %%s) = %%s") % {
+            'table': qn(Account._meta.db_table), 
+            'path': qn(Account._meta.get_field('path').column), 
+            'system': qn(Account._meta.get_field('system').column),
+        }
+        old_prefix = old_path + ACCOUNT_PATH_SEPARATOR
+        connection.cursor().execute(sql, [self.path, len(old_path) + 1, self.system_id, len(old_prefix), old_prefix])
+        transaction.commit_unless_managed(using=using)
     
     def get_child(self, name):
         """
@@ -608,6 +1047,8 @@ class Account(models.Model):
         
         If no child with that name exists, raise ``Account.DoesNotExist``." 
         """      
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return AccountTree.for_system(self.system_id).get_child(self, name)
         child = Account.objects.get(parent=self, name=name)
         return child 
     
@@ -618,6 +1059,44 @@ class Account(models.Model):
         children = Account.objects.filter(parent=self)
         return children
     
+    def cached_children(self):
+        """
+        Return the children for this account, as a list of ``Account`` instances.
+        
+        If account trees are cached (see ``AccountTree``), children are read from 
+        the cached tree, without hitting the DB.
+        """
+        if ACCOUNTING_CACHE_ACCOUNT_TREES:
+            return AccountTree.for_system(self.system_id).get_children(self)
+        return list(self.get_children())
+    
+    def get_descendants(self, include_self=False):
+        """
+        Return the descendants of this account (i.e. its children, their children, and so on), 
+        as a ``QuerySet``; if ``include_self`` is ``True``, include this account, too.
+        
+        Since account paths are materialized, descendants are retrieved by a single prefix query
+        over paths, no matter how deep the subtree is.
+        """
+        return Account.objects.filter(self._get_subtree_filter('', include_self))
+    
+    def descendant_entries(self, include_self=False):
+        """
+        Return the queryset of entries written to the ledgers of the descendants of this account;
+        if ``include_self`` is ``True``, include entries written to the ledger of this account, too.
+        """
+        return LedgerEntry.objects.filter(self._get_subtree_filter('account__', include_self))
+    
+    def _get_subtree_filter(self, prefix, include_self):
+        # build a ``Q`` object selecting (objects related to) the accounts in this account's subtree
+        if self.is_root:
+            subtree = models.Q(**{prefix + 'system': self.system_id}) & ~models.Q(**{prefix + 'pk': self.pk})
+        else:
+            subtree = models.Q(**{prefix + 'system': self.system_id, prefix + 'path__startswith': self.path + ACCOUNT_PATH_SEPARATOR})
+        if include_self:
+            subtree |= models.Q(**{prefix + 'pk': self.pk})
+        return subtree
+    
     def add_child(self, name, kind=None, is_placeholder=False):
         """
         Add a child account to this account.
@@ -626,17 +1105,190 @@ class Account(models.Model):
         
         If child account's type is not specified, assume that of its parent.
         """
-        # if child's account type is not specified, use that of its parent 
-        kind = kind or self.kind
-        try: 
-            self.get_child(name=name)
-        except Account.DoesNotExist:
-            self.system.add_account(parent_path=self.path, name=name, kind=kind, is_placeholder=is_placeholder)
-        else:
+        (child, created) = self.get_or_create_child(name, kind, is_placeholder)
+        if not created:
             raise InvalidAccountingOperation("A child account already exists with name %s" % name)  
     
+    @atomic
+    def move_to(self, new_parent):
+        """
+        Move this account (along with its descendants) below the account ``new_parent``.
+        
+        If ``new_parent`` is this account or one of its descendants, or if this is a root account, 
+        raise ``InvalidAccountingOperation``; the same happens if ``new_parent`` has already 
+        a child named as this account.
+        
+        Ledger entries are left untouched, while descendants' paths are updated 
+        by a single UPDATE statement. 
+        """
+        if self.is_root:
+            raise InvalidAccountingOperation(ugettext(u"Root accounts can't be moved"))
+        if new_parent.pk == self.pk or new_parent.path.startswith(self.path + ACCOUNT_PATH_SEPARATOR):
+            raise InvalidAccountingOperation(ugettext(u"An account can't be moved below itself"))
+        self._relocate(new_parent, self.name)
+    
+    @atomic
+    def rename(self, name):
+        """
+        Rename this account to ``name``.
+        
+        If this is a root account, or if its parent has already a child named ``name``, 
+        raise ``InvalidAccountingOperation``.
+        
+        Ledger entries are left untouched, while descendants' paths are updated 
+        by a single UPDATE statement. 
+        """
+        if self.is_root:
+            raise InvalidAccountingOperation(ugettext(u"Root accounts can't be renamed"))
+        self._relocate(self.parent, name)
+    
+    def _relocate(self, parent, name):
+        # set the parent and the name of this account, updating descendants' paths 
+        if Account.objects.filter(parent=parent, name=name).exclude(pk=self.pk).exists():
+            raise InvalidAccountingOperation(ugettext(u"A child account already exists with name %s") % name)
+        (old_parent, old_name) = (self.parent, self.name)
+        self.parent = parent
+        self.name = name
+        try:
+            self.save()
+        except:
+            # don't leave this instance in an inconsistent state 
+            (self.parent, self.name) = (old_parent, old_name)
+            raise
+    
+    def get_or_create_child(self, name, kind=None, is_placeholder=False):
+        """
+        Return the child of this account named ``name``, creating it if it doesn't exist yet.
+        Return a tuple ``(account, created)``, where ``created`` is a boolean flag specifying 
+        whether the account was created.
+        
+        If child account's type is not specified, assume that of its parent; 
+        ``kind`` and ``is_placeholder`` are ignored if the child already exists.  
+        
+        At most one read and one insert are performed; it's safe to call this method 
+        concurrently, since the uniqueness of children's names is enforced by the DB.
+        """
+        try:
+            return (self.get_child(name), False)
+        except Account.DoesNotExist:
+            # if child's account type is not specified, use that of its parent
+            child = Account(system_id=self.system_id, parent=self, name=name, kind=kind or self.kind, is_placeholder=is_placeholder)
+            child.path = child._get_path_from_parent()
+            # perform model validation, except for uniqueness checks and existence checks 
+            # on related objects (they would require more queries, and aren't needed here) 
+            child.clean_fields(exclude=['system', 'parent', 'kind'])
+            child.clean()
+            try:
+                sid = transaction.savepoint()
+                # bypass ``Account.save()``, since validation has already been performed 
+                super(Account, child).save(force_insert=True)
+                transaction.savepoint_commit(sid)
+                return (child, True)
+            except IntegrityError:
+                # another caller has just created the same child 
+                transaction.savepoint_rollback(sid)
+                return (Account.objects.get(parent=self, name=name), False)
+    
     class Meta:
-        unique_together = ('parent', 'name')
+        unique_together = (('parent', 'name'), ('system', 'path'))
+
+
+class AccountTree(object):
+    """
+    An in-memory copy of the tree of accounts belonging to an accounting system,
+    allowing to navigate it without hitting the DB.
+    
+    Trees are loaded (by a single query) the first time they are needed and cached
+    within the current process, until an account of that system is saved or deleted; 
+    this only happens if the ``ACCOUNTING_CACHE_ACCOUNT_TREES`` setting is enabled.
+    
+    Note that cached ``Account`` instances are shared among callers, so they shouldn't be 
+    modified in place; since balances are always read from the DB, they are never stale.
+    """
+    # cached trees, keyed by accounting system ID 
+    _trees = {}
+    
+    def __init__(self, system_id):
+        self.system_id = system_id
+        self.root = None
+        # map paths to accounts
+        self.accounts = {}
+        # map account IDs to the (ordered) list of their children
+        self.children = {}
+        accounts = Account.objects.filter(system=system_id).order_by('path')
+        by_id = {}
+        for account in accounts:
+            by_id[account.pk] = account
+            self.accounts[account.path] = account
+            self.children[account.pk] = []
+        for account in by_id.values():
+            if account.parent_id is None:
+                self.root = account
+            else:
+                # link accounts to their parents, so that accessing ``.parent`` doesn't hit the DB
+                account._parent_cache = by_id[account.parent_id]
+                self.children[account.parent_id].append(account)
+        for children in self.children.values():
+            children.sort(key=lambda account: account.name)
+        if self.root is None:
+            raise MalformedAccountTree(ugettext(u"No root account was created for the account system with ID %s") % system_id)
+    
+    @classmethod
+    def for_system(cls, system_id):
+        """
+        Return the tree of accounts belonging to the accounting system with ID ``system_id``,
+        loading it if it isn't cached yet. 
+        """
+        tree = cls._trees.get(system_id)
+        if tree is None:
+            tree = cls._trees[system_id] = cls(system_id)
+        return tree
+    
+    @classmethod
+    def invalidate(cls, system_id):
+        """
+        Drop the cached tree of accounts for the accounting system with ID ``system_id`` (if any).
+        """
+        cls._trees.pop(system_id, None)
+    
+    def get_account(self, path):
+        """
+        Return the account living at location ``path`` within this tree.
+        
+        If no account exists at that location, raise ``Account.DoesNotExist``.
+        """
+        try:
+            return self.accounts[path]
+        except KeyError:
+            raise Account.DoesNotExist(ugettext(u"No account exists at this location: %s") % path)
+    
+    def get_child(self, account, name):
+        """
+        Return the child of ``account`` named ``name``.
+        
+        If no child with that name exists, raise ``Account.DoesNotExist``.
+        """
+        for child in self.children.get(account.pk, []):
+            if child.name == name:
+                return child
+        raise Account.DoesNotExist(ugettext(u"Account %(path)s has no child named %(name)s") % {'path': account.path, 'name': name})
+    
+    def get_children(self, account):
+        """
+        Return the list of children of ``account``, ordered by name.
+        """
+        return list(self.children.get(account.pk, []))
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_tree(sender, instance, **kwargs):
+    """
+    When an account is saved or deleted, drop the cached tree 
+    of the accounting system it belongs to. 
+    """
+    if ACCOUNTING_CACHE_ACCOUNT_TREES:
+        AccountTree.invalidate(instance.system_id)
         
 
 class CashFlow(models.Model):
@@ -763,10 +1415,10 @@ class Split(models.Model):
             except AssertionError:
                 raise ValidationError(ugettext(u"If no exit-point is set for a split, no entry-point must be set, either."))      
         ## ``entry_point`` must be a flux-like account
-        if not self.entry_point.is_flux:
+        if self.entry_point and not self.entry_point.is_flux:
                 raise ValidationError(ugettext(u"Entry-points must be flux-like accounts"))
         ## ``exit_point`` must be a flux-like account
-        if not self.exit_point.is_flux:
+        if self.exit_point and not self.exit_point.is_flux:
                 raise ValidationError(ugettext(u"Exit-points must be flux-like accounts"))
         ## ``target`` must be a stock-like account
         if not self.target.account.is_stock:
@@ -827,7 +1479,7 @@ class Transaction(models.Model):
      
     """   
     # when the transaction happened
-    date = models.DateTimeField(default=datetime.now)
+    date = models.DateTimeField(default=datetime.now, db_index=True)
     # what the transaction represents
     description = models.CharField(max_length=512, help_text=_("Reason of the transaction"))
     # who triggered the transaction
@@ -898,6 +1550,11 @@ class Transaction(models.Model):
     
     # model-level custom validation goes here
     def clean(self):
+        # splits can't be attached to a transaction until it has been saved, so this check 
+        # only applies to existing transactions; new ones are validated by factory functions 
+        # before writing them (see ``simple_accounting.utils.validate_transaction_specs``)  
+        if not self.pk:
+            return
         ## check that the *law of conservation of money* is satisfied
         flows = [self.source]
         for split in self.splits:
@@ -1018,6 +1675,12 @@ class LedgerEntry(models.Model):
     entry_id = models.PositiveIntegerField(null=True, blank=True, editable=False)
     # the amount of money flowing 
     amount = CurrencyField()
+    # the balance of the account right after this entry was written to the ledger
+    balance_after = CurrencyField(default=0, editable=False)
+    # whether this entry has already been taken into account by ledger aggregates
+    is_aggregated = models.BooleanField(default=False, db_index=True, editable=False)
+    
+    objects = LedgerEntryManager()
     
     @property
     def date(self):
@@ -1059,23 +1722,148 @@ class LedgerEntry(models.Model):
         pass
     
     def save(self, *args, **kwargs):
+        created = not self.pk
         # if this entry is saved to the DB for the first time,
         # set its ID in the ledger to the first available value
-        if not self.pk:
-            self.entry_id = self.next_entry_id_for_ledger() 
+        if created:
+            self.entry_id = self.next_entry_id_for_ledger()
+            # the balance of the account after this entry, based on 
+            # the last entry preceding this one in the ledger
+            self.balance_after = self.previous_balance() + self.amount
         # perform model validation
         self.full_clean()
         super(LedgerEntry, self).save(*args, **kwargs)
+        if created:
+            # update the balance of the account this entry was written to;
+            # the update is performed at the DB level, so concurrent writers can't clash 
+            Account.objects.filter(pk=self.account_id).update(current_balance=models.F('current_balance') + self.amount)
+            if ACCOUNTING_CACHE_TOTAL_AMOUNT:
+                AccountSystem.invalidate_total_amount(self.account.system_id)
+            # if this entry has been back-dated, shift the running balances of later entries 
+            later_entries = LedgerEntry.objects.filter(account=self.account_id, transaction__date__gt=self.date)
+            later_entries.update(balance_after=models.F('balance_after') + self.amount)
+            # the same goes for balance snapshots covering this entry
+            later_snapshots = BalanceSnapshot.objects.filter(account=self.account_id, period_end__gt=self.date)
+            later_snapshots.update(balance=models.F('balance') + self.amount)
       
     def next_entry_id_for_ledger(self):
         """
         Get the first available integer to be used as an ID for this entry in the ledger.
+        
+        IDs are allocated from a per-ledger counter (see ``Account.objects.reserve_entry_ids``), 
+        so this takes constant time, no matter how many entries the ledger already contains.
+        """
+        return Account.objects.reserve_entry_ids(self.account_id)
+    
+    def previous_balance(self):
         """
-        existing_entries = self.account.ledger_entries
-        next_id = max([entry.id for entry in existing_entries]) + 1
-        return next_id
+        The balance of the account this entry belongs to, just before this entry was written. 
         
+        Ledger entries are ordered by the date of their transaction first, 
+        and by their ID in the ledger then.
+        """
+        previous_entries = LedgerEntry.objects.filter(account=self.account_id)
+        previous_entries = previous_entries.filter(models.Q(transaction__date__lt=self.date) \
+                                                   | models.Q(transaction__date=self.date, entry_id__lt=self.entry_id))
+        previous_entries = previous_entries.order_by('-transaction__date', '-entry_id')
+        try:
+            return previous_entries.values_list('balance_after', flat=True)[0]
+        except IndexError:
+            return 0
+
+
+@receiver(pre_delete, sender=LedgerEntry)
+def revert_ledger_entry(sender, instance, **kwargs):
+    """
+    When a ledger entry is deleted (e.g. when updating a transaction), 
+    revert its effect on the balance of the account it was written to, 
+    and on the running balances of later entries. 
+    """
+    Account.objects.filter(pk=instance.account_id).update(current_balance=models.F('current_balance') - instance.amount)
+    if ACCOUNTING_CACHE_TOTAL_AMOUNT:
+        AccountSystem.invalidate_total_amount(instance.account.system_id)
+    later_entries = LedgerEntry.objects.filter(account=instance.account_id)
+    later_entries = later_entries.filter(models.Q(transaction__date__gt=instance.date) \
+                                         | models.Q(transaction__date=instance.date, entry_id__gt=instance.entry_id))
+    later_entries.update(balance_after=models.F('balance_after') - instance.amount)
+    later_snapshots = BalanceSnapshot.objects.filter(account=instance.account_id, period_end__gt=instance.date)
+    later_snapshots.update(balance=models.F('balance') - instance.amount)
+    LedgerAggregate.objects.revert_entry(instance)
+
+
+class BalanceSnapshot(models.Model):
+    """
+    The balance of an account at the end of a given period of time (e.g. a month). 
+    
+    Snapshots are checkpoints allowing to compute historical balances without 
+    replaying the whole ledger; they are taken periodically (see the ``snapshot_balances`` 
+    management command), and kept up-to-date when ledger entries falling within 
+    an already snapshotted period are written or deleted.
+    """
+    account = models.ForeignKey(Account, related_name='snapshot_set')
+    # the end of the period covered by this snapshot;
+    # only transactions happened *before* this date contribute to the balance
+    period_end = models.DateTimeField(db_index=True)
+    # the balance of the account at the end of the period
+    balance = CurrencyField()
+    
+    def __unicode__(self):
+        return ugettext("Balance of %(account)s at %(date)s") % {'account' : self.account, 'date' : self.period_end}
+    
+    class Meta:
+        unique_together = ('account', 'period_end')
+
+
+class LedgerAggregate(models.Model):
+    """
+    The aggregate of the ledger entries written to an account during a given period of time
+    (a day or a month) by transactions of a given type.  
+    
+    Aggregates are a materialized view over ledger entries, meant for efficiently 
+    generating reports (e.g. monthly incomes/expenses) spanning long periods of time.  
+    They are refreshed incrementally (see ``LedgerAggregateManager.refresh()`` and 
+    the ``refresh_ledger_aggregates`` management command), processing only ledger entries 
+    which haven't been aggregated yet.
+    """
+    (DAY, MONTH) = range(0,2)
     
+    GRANULARITY_CHOICES = (
+        (DAY, _('Day')),
+        (MONTH, _('Month')),
+    )
+    
+    account = models.ForeignKey(Account, related_name='aggregate_set')
+    granularity = models.IntegerField(choices=GRANULARITY_CHOICES)
+    # the first day of the period this aggregate refers to
+    period_start = models.DateField(db_index=True)
+    # the type of the transactions generating aggregated entries
+    # (the empty string stands for transactions having no type)
+    transaction_kind = models.CharField(max_length=128, blank=True)
+    # the algebraic sum of aggregated entries
+    total = CurrencyField(default=0)
+    # how many entries have been aggregated
+    count = models.PositiveIntegerField(default=0)
+    
+    objects = LedgerAggregateManager()
+    
+    @classmethod
+    def get_period_start(cls, date, granularity):
+        """
+        Return the first day of the period of type ``granularity`` containing ``date``.
+        """
+        if granularity == cls.DAY:
+            return date.date()
+        elif granularity == cls.MONTH:
+            return date.date().replace(day=1)
+        raise ValueError("Invalid granularity for a ledger aggregate: %s" % granularity)
+    
+    def __unicode__(self):
+        return ugettext("Aggregate of %(account)s for the period starting at %(date)s") % {'account' : self.account, 'date' : self.period_start}
+    
+    class Meta:
+        unique_together = ('account', 'granularity', 'period_start', 'transaction_kind')
+
+
 class Invoice(models.Model):
     """
     An invoice document issued by a subject against another subject.
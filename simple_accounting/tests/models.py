@@ -252,7 +252,7 @@ class Person(models.Model):
         self.subject.init_accounting_system()
         system = self.accounting.system
         # create a generic asset-type account (a sort of "virtual wallet")
-        system.add_account(parent_path='/', name='wallet', kind=account_type.asset)  
+        system.build_tree({'wallet': {'kind': account_type.asset}})
        
     def is_member(self, gas):
         """
@@ -298,16 +298,22 @@ class GAS(models.Model):
         self.subject.init_accounting_system()
         system = self.accounting.system
         ## setup a base account hierarchy
-        # GAS's cash       
-        system.add_account(parent_path='/', name='cash', kind=account_type.asset) 
-        # root for GAS members' accounts 
-        system.add_account(parent_path='/', name='members', kind=account_type.asset, is_placeholder=True)
-        # a placeholder for organizing transactions representing payments to suppliers
-        system.add_account(parent_path='/expenses', name='suppliers', kind=account_type.expense, is_placeholder=True)
-        # recharges made by GAS members to their own account
-        system.add_account(parent_path='/incomes', name='recharges', kind=account_type.income)
-        # membership fees
-        system.add_account(parent_path='/incomes', name='fees', kind=account_type.income)
+        system.build_tree({
+            # GAS's cash
+            'cash': {'kind': account_type.asset},
+            # root for GAS members' accounts
+            'members': {'kind': account_type.asset, 'is_placeholder': True},
+            'expenses': {'children': {
+                # a placeholder for organizing transactions representing payments to suppliers
+                'suppliers': {'kind': account_type.expense, 'is_placeholder': True},
+            }},
+            'incomes': {'children': {
+                # recharges made by GAS members to their own account
+                'recharges': {'kind': account_type.income},
+                # membership fees
+                'fees': {'kind': account_type.income},
+            }},
+        })
         
     @property
     def pacts(self):
@@ -345,17 +351,17 @@ class GASMember(models.Model):
         
         ## account creation
         ## Person-side
-        # placeholder for payments made by this person to GASs (s)he belongs to
-        try:
-            person_system['/expenses/gas'] 
-        except Account.DoesNotExist:
-            person_system.add_account(parent_path='/expenses', name='gas', kind=account_type.expense, is_placeholder=True)
-        # base account for expenses related to this GAS membership
-        person_system.add_account(parent_path='/expenses/gas', name=self.gas.uid, kind=account_type.expense, is_placeholder=True)
-        # recharges
-        person_system.add_account(parent_path='/expenses/gas/' + self.gas.uid, name='recharges', kind=account_type.expense)
-        # membership fees
-        person_system.add_account(parent_path='/expenses/gas/' + self.gas.uid, name='fees', kind=account_type.expense)
+        # placeholder for payments made by this person to GASs (s)he belongs to 
+        # (it's only created if missing)
+        person_system.build_tree({'gas': {'kind': account_type.expense, 'is_placeholder': True, 'children': {
+            # base account for expenses related to this GAS membership
+            self.gas.uid: {'kind': account_type.expense, 'is_placeholder': True, 'children': {
+                # recharges
+                'recharges': {'kind': account_type.expense},
+                # membership fees
+                'fees': {'kind': account_type.expense},
+            }},
+        }}}, parent_path='/expenses')
         ## GAS-side   
         gas_system.add_account(parent_path='/members', name=self.uid, kind=account_type.asset)
     
@@ -388,10 +394,14 @@ class Supplier(models.Model):
         self.subject.init_accounting_system()
         system = self.accounting.system
         ## setup a base account hierarchy   
-        # a generic asset-type account (a sort of "virtual wallet")        
-        system.add_account(parent_path='/', name='wallet', kind=account_type.asset)  
-        # a placeholder for organizing transactions representing GAS payments
-        system.add_account(parent_path='/incomes', name='gas', kind=account_type.income, is_placeholder=True)
+        system.build_tree({
+            # a generic asset-type account (a sort of "virtual wallet")
+            'wallet': {'kind': account_type.asset},
+            'incomes': {'children': {
+                # a placeholder for organizing transactions representing GAS payments
+                'gas': {'kind': account_type.income, 'is_placeholder': True},
+            }},
+        })
         
     @property
     def uid(self):
@@ -14,18 +14,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.contenttypes.models import ContentType 
 
+import simple_accounting.models
+
 from simple_accounting.models import account_type, BasicAccountTypeDict, AccountType
 from simple_accounting.models import Subject, AccountSystem, Account, CashFlow, Split, Transaction, LedgerEntry, Invoice
+from simple_accounting.models import BalanceSnapshot, LedgerAggregate, AccountTree
 from simple_accounting.exceptions import MalformedPathString, InvalidAccountingOperation, MalformedAccountTree, MalformedTransaction, SubjectiveAPIError
 from simple_accounting.utils import register_split_transaction, register_transaction, register_internal_transaction, register_simple_transaction
+from simple_accounting.utils import trial_balance, register_transactions_bulk, validate_transaction_specs, PostingQueue
+from simple_accounting.lib import atomic
 
 from simple_accounting.tests.models import Person, GAS, Supplier
 from simple_accounting.tests.models import GASSupplierSolidalPact, GASMember
 from simple_accounting.tests.models import GASSupplierOrder, GASSupplierOrderProduct, GASMemberOrder, GASSupplierStock
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.core.cache import cache
+
+from datetime import datetime, date
+from decimal import Decimal
 
 
 class DES(object):
@@ -384,6 +394,12 @@ class AccountSystemModelTest(TestCase):
     def testGetRoot(self):
         """Check that the property ``.root()`` works as advertised """
         self.assertEqual(self.system.root, self.root)
+        
+    def testGetRootFailIfMissing(self):
+        """If no root account exists for an accounting system, accessing ``.root`` should raise ``MalformedAccountTree``"""
+        Account.objects.filter(system=self.system).delete()
+        system = AccountSystem.objects.get(pk=self.system.pk)
+        self.assertRaises(MalformedAccountTree, getattr, system, 'root')
     
     def testGetAccounts(self):
         """Check that the property ``.accounts()`` works as advertised """
@@ -411,6 +427,29 @@ class AccountSystemTreeNavigationTest(TestCase):
         self.bar = Account.objects.create(system=self.system, parent=self.spam, name='bar', kind=account_type.asset)
         self.baz = Account.objects.create(system=self.system, parent=self.spam, name='baz', kind=account_type.liability)
     
+    def testDictProtocol(self):
+        """Check that accounting systems behave like dictionaries mapping paths to accounts"""
+        paths = ['/', '/cheese', '/spam', '/spam/bar', '/spam/baz']
+        self.assertEqual(self.system.keys(), paths)
+        self.assertEqual(list(self.system), paths)
+        self.assertEqual(self.system.values(), [self.root, self.cheese, self.spam, self.bar, self.baz])
+        self.assertEqual(self.system.items(), zip(paths, [self.root, self.cheese, self.spam, self.bar, self.baz]))
+        self.assertEqual(len(self.system), 5)
+        self.assertTrue('/spam/bar' in self.system)
+        self.assertFalse('/spam/ham' in self.system)
+        self.assertFalse('spam' in self.system)
+        self.assertEqual(self.system.get('/spam'), self.spam)
+        self.assertEqual(self.system.get('/spam/ham'), None)
+        self.assertEqual(self.system.get('/spam/ham', self.root), self.root)
+    
+    def testResolvePaths(self):
+        """Check that ``Account.objects.resolve_paths()`` works as advertised"""
+        other_system = Person.objects.create(name="Giorgio", surname="Verdi").accounting.system
+        accounts = Account.objects.resolve_paths([(self.system, '/spam/bar'), (other_system, '/incomes'), (self.system, '/')])
+        self.assertEqual(accounts, [self.bar, other_system['/incomes'], self.root])
+        self.assertRaises(Account.DoesNotExist, Account.objects.resolve_paths, [(self.system, '/spam'), (other_system, '/spam')])
+        self.assertRaises(MalformedPathString, Account.objects.resolve_paths, [(self.system, 'spam')])
+    
     def testGetAccountFromPathOK(self):
         """Test normal behaviour of the ``.get_account_from_path()`` method"""
         self.assertEqual(self.system.get_account_from_path('/spam'), self.spam)  
@@ -497,8 +536,143 @@ class AccountSystemTreeNavigationTest(TestCase):
         """Check that the method ``.get_children()`` works as advertised"""
         self.assertEqual(set(self.root.get_children()), set((self.spam, self.cheese)))
         self.assertEqual(set(self.spam.get_children()), set((self.bar, self.baz)))
+        self.assertEqual(set(self.spam.cached_children()), set((self.bar, self.baz)))
 
 
+class AccountTreeCacheTest(TestCase):
+    """Tests for the in-process cache of account trees"""
+   
+    def setUp(self):
+        # enable caching of account trees
+        self._cache_account_trees = simple_accounting.models.ACCOUNTING_CACHE_ACCOUNT_TREES
+        simple_accounting.models.ACCOUNTING_CACHE_ACCOUNT_TREES = True
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.subject = self.person.subject
+        self.system = self.person.accounting.system
+        # sweep away auto-created accounts
+        Account.objects.all().delete()
+        # setup a test account system
+        self.root = Account.objects.create(system=self.system, parent=None, name='', kind=account_type.root, is_placeholder=True)
+        self.spam = Account.objects.create(system=self.system, parent=self.root, name='spam', kind=account_type.asset)
+        self.bar = Account.objects.create(system=self.system, parent=self.spam, name='bar', kind=account_type.asset)
+        
+    def tearDown(self):
+        AccountTree._trees.clear()
+        simple_accounting.models.ACCOUNTING_CACHE_ACCOUNT_TREES = self._cache_account_trees
+    
+    def testNavigation(self):
+        """Check that cached trees can be navigated as usual"""
+        self.assertEqual(self.system.root, self.root)
+        self.assertEqual(self.system['/spam/bar'], self.bar)
+        self.assertEqual(self.spam.get_child('bar'), self.bar)
+        self.assertEqual(self.spam.cached_children(), [self.bar])
+        # the return type of ``.get_children()`` doesn't depend on caching
+        self.assertEqual(self.spam.get_children().count(), 1)
+        self.assertRaises(Account.DoesNotExist, self.system.get_account_from_path, '/spam/ham')
+        self.assertRaises(Account.DoesNotExist, self.spam.get_child, 'ham')
+    
+    def testInvalidation(self):
+        """Cached trees should be invalidated when accounts are added or renamed"""
+        self.assertEqual(self.system['/spam/bar'], self.bar)
+        self.spam.add_child('baz')
+        self.assertEqual(self.system['/spam/baz'].name, 'baz')
+        self.spam.name = 'ham'
+        self.spam.save()
+        self.assertEqual(self.system['/ham/bar'], self.bar)
+        self.assertRaises(Account.DoesNotExist, self.system.get_account_from_path, '/spam/bar')
+        
+
+class AccountSystemReportingTest(TestCase):
+    """Tests for the reporting API of accounting systems"""
+   
+    def setUp(self):
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.subject = self.person.subject
+        self.system = self.person.accounting.system
+        # sweep away auto-created accounts
+        Account.objects.all().delete()
+        # setup a test account system
+        self.root = Account.objects.create(system=self.system, parent=None, name='', kind=account_type.root, is_placeholder=True)
+        self.spam = Account.objects.create(system=self.system, parent=self.root, name='spam', kind=account_type.asset, is_placeholder=True)
+        self.cheese = Account.objects.create(system=self.system, parent=self.root, name='cheese', kind=account_type.asset)
+        self.bar = Account.objects.create(system=self.system, parent=self.spam, name='bar', kind=account_type.asset)
+        self.baz = Account.objects.create(system=self.system, parent=self.spam, name='baz', kind=account_type.liability)
+        register_simple_transaction(self.cheese, self.bar, 10, "cheese to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.cheese, self.baz, 3, "cheese to baz", self.subject, date=datetime(2011, 1, 2))
+    
+    def testRollupBalances(self):
+        """Check that the method ``.rollup_balances()`` works as advertised"""
+        balances = self.system.rollup_balances()
+        self.assertEqual(balances['/spam/bar'], (10, 10))
+        self.assertEqual(balances['/spam/baz'], (3, 3))
+        self.assertEqual(balances['/spam'], (0, 13))
+        self.assertEqual(balances['/cheese'], (-13, -13))
+        self.assertEqual(balances['/'], (0, 0))
+        
+    def testGetTotalAmount(self):
+        """Check that the property ``.total_amount`` only takes into account stock-like accounts"""
+        self.assertEqual(self.system.total_amount, 0)
+        ham = Account.objects.create(system=self.system, parent=self.root, name='ham', kind=account_type.income)
+        # flux-like accounts don't contribute to the total amount
+        LedgerEntry.objects.create(account=ham, transaction=Transaction.objects.all()[0], amount=5)
+        LedgerEntry.objects.create(account=self.cheese, transaction=Transaction.objects.all()[0], amount=7)
+        self.assertEqual(self.system.total_amount, 7)
+    
+    def testWalk(self):
+        """Check that the method ``.walk()`` visits the account tree depth-first"""
+        self.spam.add_child('ham')
+        self.system['/spam/ham'].add_child('egg')
+        walk = [(depth, account.path) for (depth, account) in self.system.walk()]
+        self.assertEqual(walk, [(0, '/'), (1, '/cheese'), (1, '/spam'), (2, '/spam/bar'), (2, '/spam/baz'), (2, '/spam/ham'), (3, '/spam/ham/egg')])
+        balances = [(account.path, account.balance) for (depth, account) in self.system.walk(with_balances=True)]
+        self.assertEqual(balances[:4], [('/', 0), ('/cheese', -13), ('/spam', 0), ('/spam/bar', 10)])
+        
+    def testFind(self):
+        """Check that the method ``.find()`` works as advertised"""
+        self.assertEqual(set(self.system.find('/spam/*')), set([self.bar, self.baz]))
+        self.assertEqual(set(self.system.find('/*')), set([self.spam, self.cheese]))
+        self.assertEqual(set(self.system.find('/sp?m/ba?')), set([self.bar, self.baz]))
+        self.assertEqual(set(self.system.find('/*/bar')), set([self.bar]))
+        self.assertEqual(set(self.system.find('/spam')), set([self.spam]))
+        self.assertEqual(set(self.system.find('/ham/*')), set())
+        self.assertRaises(MalformedPathString, self.system.find, 'spam/*')
+        # non-ASCII letters and regex metacharacters are matched literally
+        activity = Account.objects.create(system=self.system, parent=self.cheese, name=u'attivit\xe0 (1.0)', kind=account_type.asset)
+        self.assertEqual(set(self.system.find(u'/cheese/attivit\xe0 (?.?)')), set([activity]))
+        self.assertEqual(set(self.system.find(u'/cheese/*\xe0*')), set([activity]))
+        self.assertEqual(set(self.system.find(u'/cheese/attivit\xe0 (1x0)*')), set())
+    
+    def testFindBalance(self):
+        """Check that the method ``.find_balance()`` works as advertised"""
+        self.assertEqual(self.system.find_balance('/spam/*'), 13)
+        self.assertEqual(self.system.find_balance('/*'), -13)
+        self.assertEqual(self.system.find_balance('/ham/*'), 0)
+    
+    def testTotalAmountsFor(self):
+        """Check that ``AccountSystem.objects.total_amounts_for()`` returns the total amount of each given subject"""
+        LedgerEntry.objects.create(account=self.cheese, transaction=Transaction.objects.all()[0], amount=7)
+        other_person = Person.objects.create(name="Giorgio", surname="Verdi")
+        totals = AccountSystem.objects.total_amounts_for(Subject.objects.filter(pk__in=[self.subject.pk, other_person.subject.pk]))
+        self.assertEqual(totals, {self.subject.pk: 7, other_person.subject.pk: 0})
+        # worker processes can't be used within a managed transaction (as tests are run) 
+        self.assertRaises(InvalidAccountingOperation, AccountSystem.objects.total_amounts_for, Subject.objects.all(), processes=2)
+    
+    def testTrialBalance(self):
+        """Check that a trial balance lists debits and credits for each account, and that they match"""
+        ham = Account.objects.create(system=self.system, parent=self.root, name='ham', kind=account_type.income)
+        LedgerEntry.objects.create(account=ham, transaction=Transaction.objects.all()[0], amount=5)
+        LedgerEntry.objects.create(account=self.cheese, transaction=Transaction.objects.all()[0], amount=5)
+        report = trial_balance(self.system)
+        rows = list(report)
+        self.assertEqual(rows[0], ('/cheese', AccountType.ASSET, 5, 13))
+        self.assertEqual(rows[1], ('/spam/bar', AccountType.ASSET, 10, 0))
+        self.assertEqual(rows[2], ('/spam/baz', AccountType.LIABILITY, 3, 0))
+        self.assertEqual(rows[3], ('/ham', AccountType.INCOME, 0, 5))
+        self.assertEqual(report.total_debit, 18)
+        self.assertEqual(report.total_credit, 18)
+        self.assertTrue(report.is_balanced)
+        
+
 class AccountSystemManipulationTest(TestCase):
     """Tests for the account-tree manipulation API"""
    
@@ -507,6 +681,7 @@ class AccountSystemManipulationTest(TestCase):
         self.subject = self.person.subject
         self.system = self.person.accounting.system
         # sweep away auto-created accounts
+        Account.objects.all().delete()
         self.root = Account.objects.create(system=self.system, parent=None, name='', kind=account_type.root, is_placeholder=True)
         self.spam = Account.objects.create(system=self.system, parent=self.root, name='spam', kind=account_type.asset)
         self.cheese = Account.objects.create(system=self.system, parent=self.root, name='cheese', kind=account_type.income)
@@ -570,6 +745,105 @@ class AccountSystemManipulationTest(TestCase):
         self.assertRaises(InvalidAccountingOperation, self.spam.add_child, 'bar', kind=account_type.asset)
         self.assertRaises(InvalidAccountingOperation, self.spam.add_child, 'bar', kind=account_type.liability)
     
+    def testPathTooLong(self):
+        """If an account's path (or that of one of its descendants) would be too long, raise ``ValidationError``"""
+        deep = Account.objects.create(system=self.system, parent=self.bar, name='a'*125, kind=account_type.asset)
+        self.assertRaises(ValidationError, Account.objects.create, system=self.system, parent=deep, name='b'*128, kind=account_type.asset)
+        self.spam.name = 'c'*128
+        self.assertRaises(ValidationError, self.spam.save)
+        # nothing has been changed
+        self.assertEqual(Account.objects.get(pk=self.spam.pk).path, '/spam')
+        self.assertEqual(Account.objects.get(pk=deep.pk).path, '/spam/bar/' + 'a'*125)
+    
+    def testRebuildPaths(self):
+        """Check that paths stored along with accounts are rebuilt from account trees"""
+        Account.objects.filter(pk=self.spam.pk).update(path='')
+        Account.objects.filter(pk=self.bar.pk).update(path='/bar')
+        Account.objects.rebuild_paths()
+        self.assertEqual(Account.objects.get(pk=self.root.pk).path, '/')
+        self.assertEqual(Account.objects.get(pk=self.spam.pk).path, '/spam')
+        self.assertEqual(Account.objects.get(pk=self.bar.pk).path, '/spam/bar')
+        self.assertEqual(Account.objects.get(pk=self.cheese.pk).path, '/cheese')
+    
+    def testMoveTo(self):
+        """Check that the method ``.move_to()`` works as advertised"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject)
+        self.bar.add_child('ham')
+        self.bar.move_to(self.root)
+        self.assertEqual(self.system['/bar'], self.bar)
+        self.assertEqual(self.system['/bar/ham'].parent, self.bar)
+        self.assertRaises(Account.DoesNotExist, self.system.get_account_from_path, '/spam/bar/ham')
+        # ledger entries are left untouched
+        self.assertEqual(self.bar.balance, 10)
+        self.assertEqual(self.bar.ledger_entries.count(), 1)
+        
+    def testMoveToFailIfInvalid(self):
+        """If an account can't be moved to the given location, ``.move_to()`` should raise ``InvalidAccountingOperation``"""
+        self.bar.add_child('ham')
+        self.assertRaises(InvalidAccountingOperation, self.bar.move_to, self.bar)
+        self.assertRaises(InvalidAccountingOperation, self.bar.move_to, self.system['/spam/bar/ham'])
+        self.assertRaises(InvalidAccountingOperation, self.root.move_to, self.spam)
+        self.spam.add_child('bar2', kind=account_type.asset)
+        self.system['/spam/bar2'].add_child('ham')
+        self.assertRaises(InvalidAccountingOperation, self.system['/spam/bar/ham'].move_to, self.system['/spam/bar2'])
+    
+    def testRename(self):
+        """Check that the method ``.rename()`` works as advertised"""
+        self.spam.rename('egg')
+        self.assertEqual(self.system['/egg'], self.spam)
+        self.assertEqual(self.system['/egg/bar'], self.bar)
+        self.assertEqual(self.system['/egg/baz'], self.baz)
+        self.assertRaises(InvalidAccountingOperation, self.spam.rename, 'cheese')
+        self.assertRaises(InvalidAccountingOperation, self.root.rename, 'egg')
+    
+    def testGetOrCreateChild(self):
+        """Check that the method ``.get_or_create_child()`` works as advertised"""
+        (ham, created) = self.spam.get_or_create_child('ham', kind=account_type.liability, is_placeholder=True)
+        self.assertEqual(created, True)
+        self.assertEqual(ham, Account.objects.get(system=self.system, parent=self.spam, name='ham', kind=account_type.liability, is_placeholder=True))
+        self.assertEqual(ham.path, '/spam/ham')
+        self.assertEqual(self.spam.get_or_create_child('ham'), (ham, False))
+        self.assertEqual(self.spam.get_or_create_child('bar', kind=account_type.liability), (self.bar, False))
+        # child's account type defaults to that of its parent
+        (egg, created) = self.spam.get_or_create_child('egg')
+        self.assertEqual(egg.kind, account_type.asset)
+        # model validation is performed on new accounts
+        self.assertRaises(ValidationError, self.spam.get_or_create_child, 'bacon', kind=account_type.expense)
+        
+    def testBuildTree(self):
+        """Check that adding a tree of accounts by ``.build_tree()`` works as advertised"""
+        self.system.build_tree({
+            'ham': {'kind': account_type.expense, 'is_placeholder': True, 'children': {
+                'egg': {}, 
+                'bacon': {'children': {'sausage': {'kind': account_type.expense}}},
+            }},
+            # existing accounts are left untouched
+            'spam': {'children': {'egg': {}}},  
+        })
+        ham = self.system['/ham']
+        self.assertEqual((ham.parent, ham.kind, ham.is_placeholder), (self.root, account_type.expense, True))
+        egg = self.system['/ham/egg']
+        # account types default to that of the parent
+        self.assertEqual((egg.parent, egg.kind, egg.is_placeholder), (ham, account_type.expense, False))
+        self.assertEqual(self.system['/ham/bacon/sausage'].parent, self.system['/ham/bacon'])
+        self.assertEqual(self.system['/spam/egg'].kind, account_type.asset)
+        self.assertEqual(Account.objects.get(pk=self.spam.pk).kind, account_type.asset)
+        # trees may be added below a given account
+        self.system.build_tree({'spam': {}}, parent_path='/ham/egg')
+        self.assertEqual(self.system['/ham/egg/spam'].parent, egg)
+    
+    def testBuildTreeFailIfMalformed(self):
+        """If the given tree specification is invalid, ``.build_tree()`` should raise ``MalformedAccountTree`` and add no accounts"""
+        self.assertRaises(MalformedAccountTree, self.system.build_tree, {'ham': {'kind': account_type.asset, 'children': {'egg': {'kind': account_type.expense}}}})
+        self.assertRaises(MalformedAccountTree, self.system.build_tree, {'ham': {'kind': account_type.asset, 'children': {'': {}}}})
+        self.assertRaises(MalformedAccountTree, self.system.build_tree, {'ham': {'kind': account_type.asset, 'children': {'egg/bacon': {}}}})
+        # names can't be longer than the ``Account.name`` field allows
+        self.assertRaises(MalformedAccountTree, self.system.build_tree, {'ham': {'kind': account_type.asset, 'children': {'e'*200: {}}}})
+        # children of the root account must specify their type
+        self.assertRaises(MalformedAccountTree, self.system.build_tree, {'ham': {'children': {'egg': {'kind': account_type.asset}}}})
+        self.assertRaises(Account.DoesNotExist, self.system.build_tree, {'ham': {'kind': account_type.asset}}, parent_path='/egg')
+        self.assertEqual(Account.objects.filter(system=self.system, name='ham').count(), 0)
+    
     
 class AccountModelTest(TestCase):
     """Tests related to the ``Account`` model class"""
@@ -618,8 +892,101 @@ class AccountModelTest(TestCase):
     
     def testGetBalance(self):
         """Check that the property ``.balance`` works as advertised"""
-        # WRITEME
-        pass   
+        self.assertEqual(self.spam.balance, 0)
+        self.assertEqual(self.bar.balance, 0)
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        self.assertEqual(self.spam.balance, -10)
+        self.assertEqual(self.bar.balance, 10)
+        register_simple_transaction(self.bar, self.spam, 4, "bar to spam", self.subject, date=datetime(2011, 1, 2))
+        self.assertEqual(self.spam.balance, -6)
+        self.assertEqual(self.bar.balance, 6)
+
+    def testBalanceRevertedOnEntriesDeletion(self):
+        """When ledger entries are deleted, the balance of their accounts should be reverted"""
+        transaction = register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        transaction.ledger_entries.delete()
+        self.assertEqual(self.spam.balance, 0)
+        self.assertEqual(self.bar.balance, 0)
+
+    def testRebuildBalances(self):
+        """Check that ``AccountManager.rebuild_balances()`` recomputes balances from ledgers"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        # mess up persisted balances
+        Account.objects.all().update(current_balance=100)
+        Account.objects.rebuild_balances()
+        self.assertEqual(self.spam.balance, -10)
+        self.assertEqual(self.bar.balance, 10)
+        self.assertEqual(self.baz.balance, 0)
+
+    def testGetBalanceAt(self):
+        """Check that the method ``.balance_at()`` works as advertised"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 3, 1))
+        self.assertEqual(self.bar.balance_at(datetime(2010, 12, 31)), 0)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 1, 1)), 10)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 2, 1)), 10)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 4, 1)), 15)
+        
+    def testBackDatedEntriesShiftRunningBalances(self):
+        """Back-dated ledger entries should shift the running balances of later entries"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 3, 1))
+        # a back-dated transaction
+        register_simple_transaction(self.spam, self.bar, 2, "spam to bar", self.subject, date=datetime(2011, 2, 1))
+        running_balances = [entry.balance_after for entry in self.bar.ledger_entries.order_by('transaction__date')]
+        self.assertEqual(running_balances, [10, 12, 17])
+        self.assertEqual(self.bar.balance_at(datetime(2011, 2, 1)), 12)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 4, 1)), 17)
+
+    def testWithBalances(self):
+        """Check that ``AccountManager.with_balances()`` works as advertised"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.bar, self.baz, 3, "bar to baz", self.subject, date=datetime(2011, 1, 2))
+        accounts = list(Account.objects.with_balances())
+        # balances are read from accounts, without scanning ledgers
+        self.assertNumQueries(0, lambda: [account.balance for account in accounts])
+        for account in accounts:
+            self.assertEqual(account.balance, Account.objects.get(pk=account.pk).balance)
+            self.assertTrue(isinstance(account.balance, Decimal))
+    
+    def testBalancesFor(self):
+        """Check that ``AccountManager.balances_for()`` works as advertised"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.bar, self.baz, 3, "bar to baz", self.subject, date=datetime(2011, 1, 2))
+        balances = Account.objects.balances_for([self.spam, self.bar, self.baz, self.cheese])
+        self.assertEqual(balances, {self.spam.pk: -10, self.bar.pk: 7, self.baz.pk: 3, self.cheese.pk: 0})
+        
+    def testTakeBalanceSnapshots(self):
+        """Check that ``AccountManager.take_balance_snapshots()`` works as advertised"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 3, 1))
+        Account.objects.take_balance_snapshots(datetime(2011, 2, 1))
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.bar, period_end=datetime(2011, 2, 1)).balance, 10)
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.spam, period_end=datetime(2011, 2, 1)).balance, -10)
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.baz, period_end=datetime(2011, 2, 1)).balance, 0)
+        # taking snapshots again refreshes existing ones
+        register_simple_transaction(self.spam, self.bar, 2, "spam to bar", self.subject, date=datetime(2011, 1, 15))
+        Account.objects.take_balance_snapshots(datetime(2011, 2, 1))
+        self.assertEqual(BalanceSnapshot.objects.filter(period_end=datetime(2011, 2, 1)).count(), Account.objects.count())
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.bar, period_end=datetime(2011, 2, 1)).balance, 12)
+
+    def testGetBalanceAtFromSnapshots(self):
+        """``.balance_at()`` should take balance snapshots into account"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        Account.objects.take_balance_snapshots(datetime(2011, 2, 1))
+        register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 3, 1))
+        self.assertEqual(self.bar.balance_at(datetime(2011, 2, 1)), 10)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 4, 1)), 15)
+
+    def testSnapshotsUpdatedByBackDatedEntries(self):
+        """Writing (or deleting) ledger entries within a snapshotted period should update snapshots"""
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1))
+        Account.objects.take_balance_snapshots(datetime(2011, 2, 1))
+        transaction = register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 1, 15))
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.bar).balance, 15)
+        self.assertEqual(self.bar.balance_at(datetime(2011, 2, 1)), 15)
+        transaction.ledger_entries.delete()
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.bar).balance, 10)
        
     def testGetPath(self):
         """Check that the property ``.path`` works as advertised"""
@@ -627,7 +994,58 @@ class AccountModelTest(TestCase):
         self.assertEqual(self.spam.path, '/spam')
         self.assertEqual(self.cheese.path, '/cheese')
         self.assertEqual(self.bar.path, '/spam/bar')
-        self.assertEqual(self.baz.path, '/spam/bar')
+        self.assertEqual(self.baz.path, '/spam/baz')
+    
+    def testGetDescendants(self):
+        """Check that the method ``.get_descendants()`` works as advertised"""
+        self.assertEqual(set(self.root.get_descendants()), set([self.spam, self.cheese, self.bar, self.baz]))
+        self.assertEqual(set(self.spam.get_descendants()), set([self.bar, self.baz]))
+        self.assertEqual(set(self.spam.get_descendants(include_self=True)), set([self.spam, self.bar, self.baz]))
+        self.assertEqual(set(self.bar.get_descendants()), set())
+        
+    def testDescendantEntries(self):
+        """Check that the method ``.descendant_entries()`` works as advertised"""
+        ham = Account.objects.create(system=self.system, parent=self.root, name='ham', kind=account_type.asset)
+        register_simple_transaction(self.bar, self.baz, 3, "bar to baz", self.subject, date=datetime(2011, 1, 1))
+        register_simple_transaction(self.spam, ham, 5, "spam to ham", self.subject, date=datetime(2011, 1, 2))
+        self.assertEqual(self.spam.descendant_entries().count(), 2)
+        self.assertEqual(self.spam.descendant_entries(include_self=True).count(), 3)
+        self.assertEqual(self.root.descendant_entries().count(), 4)
+        self.assertEqual(ham.descendant_entries(include_self=True).count(), 1)
+        self.assertEqual(self.cheese.descendant_entries().count(), 0)
+    
+    def testReserveEntryIds(self):
+        """IDs in a ledger should be allocated from a per-account counter, which isn't reset by saving stale instances"""
+        self.assertEqual(Account.objects.reserve_entry_ids(self.bar.pk), 1)
+        self.assertEqual(Account.objects.reserve_entry_ids(self.bar.pk, 3), 2)
+        self.assertEqual(Account.objects.reserve_entry_ids(self.baz.pk), 1)
+        self.bar.save()
+        self.assertEqual(Account.objects.reserve_entry_ids(self.bar.pk), 5)
+    
+    def testAccountsLockedInOrder(self):
+        """Registering a transaction should update (and so lock) the accounts involved in order of their IDs"""
+        import re
+        from django.db import connection
+        table = Account._meta.db_table
+        connection.use_debug_cursor = True
+        try:
+            queries_before = len(connection.queries)
+            # the source account has been created after the target one
+            register_simple_transaction(self.baz, self.spam, 5, "baz to spam", self.subject, date=datetime(2011, 1, 1))
+            updates = [query['sql'] for query in connection.queries[queries_before:] if query['sql'].startswith('UPDATE "%s"' % table)]
+        finally:
+            connection.use_debug_cursor = False
+        locked = [int(re.search(r'"id" = (\d+)', sql).group(1)) for sql in updates]
+        self.assertEqual(locked, sorted([self.baz.pk, self.spam.pk]))
+    
+    def testPathUpdatedOnRename(self):
+        """When an account is renamed, the paths of its descendants should be updated, too"""
+        self.spam.name = 'ham'
+        self.spam.save()
+        self.assertEqual(Account.objects.get(pk=self.spam.pk).path, '/ham')
+        self.assertEqual(Account.objects.get(pk=self.bar.pk).path, '/ham/bar')
+        self.assertEqual(Account.objects.get(pk=self.baz.pk).path, '/ham/baz')
+        self.assertEqual(self.system['/ham/bar'], self.bar)
         
     def testIsRoot(self):
         """Check that root accounts are correctly recognized"""
@@ -1400,6 +1818,49 @@ class LedgerEntryModelTest(TestCase):
         pass
 
 
+class LedgerAggregateTest(TestCase):
+    """Tests related to the ``LedgerAggregate`` model class"""
+   
+    def setUp(self):
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.subject = self.person.subject
+        self.system = self.person.accounting.system
+        self.spam = Account.objects.create(system=self.system, parent=self.system.root, name='spam', kind=account_type.asset)
+        self.bar = Account.objects.create(system=self.system, parent=self.system.root, name='bar', kind=account_type.asset)
+        register_simple_transaction(self.spam, self.bar, 10, "spam to bar", self.subject, date=datetime(2011, 1, 1), kind='PAYMENT')
+        register_simple_transaction(self.spam, self.bar, 5, "spam to bar", self.subject, date=datetime(2011, 1, 15), kind='PAYMENT')
+        register_simple_transaction(self.spam, self.bar, 2, "spam to bar", self.subject, date=datetime(2011, 2, 1), kind='REFUND')
+    
+    def testRefresh(self):
+        """Check that ``LedgerAggregateManager.refresh()`` works as advertised"""
+        LedgerAggregate.objects.refresh()
+        aggregates = [(a.period_start, a.transaction_kind, a.total, a.count) for a in self.bar.ledger_aggregates(LedgerAggregate.MONTH)]
+        self.assertEqual(aggregates, [(date(2011, 1, 1), 'PAYMENT', 15, 2), (date(2011, 2, 1), 'REFUND', 2, 1)])
+        aggregates = [(a.period_start, a.total) for a in self.bar.ledger_aggregates(LedgerAggregate.DAY, start=date(2011, 1, 2))]
+        self.assertEqual(aggregates, [(date(2011, 1, 15), 5), (date(2011, 2, 1), 2)])
+        
+    def testIncrementalRefresh(self):
+        """Refreshing aggregates should only take into account entries which haven't been aggregated yet"""
+        LedgerAggregate.objects.refresh()
+        register_simple_transaction(self.spam, self.bar, 3, "spam to bar", self.subject, date=datetime(2011, 2, 10), kind='REFUND')
+        LedgerAggregate.objects.refresh()
+        aggregate = LedgerAggregate.objects.get(account=self.bar, granularity=LedgerAggregate.MONTH, period_start=date(2011, 2, 1))
+        self.assertEqual((aggregate.total, aggregate.count), (5, 2))
+        
+    def testDeletedEntriesAreReverted(self):
+        """Deleting an already aggregated ledger entry should revert its effect on aggregates"""
+        LedgerAggregate.objects.refresh()
+        Transaction.objects.get(kind='REFUND').ledger_entries.delete()
+        aggregate = LedgerAggregate.objects.get(account=self.bar, granularity=LedgerAggregate.MONTH, period_start=date(2011, 2, 1))
+        self.assertEqual((aggregate.total, aggregate.count), (0, 0))
+    
+    def testSystemLedgerAggregates(self):
+        """Check that the method ``AccountSystem.ledger_aggregates()`` works as advertised"""
+        LedgerAggregate.objects.refresh()
+        aggregates = [(a.account, a.total) for a in self.system.ledger_aggregates(LedgerAggregate.MONTH, end=date(2011, 2, 1))]
+        self.assertEqual(set(aggregates), set([(self.spam, -15), (self.bar, 15)]))
+        
+        
 class InvoiceModelTest(TestCase):
     """Tests related to the ``Invoice`` model class"""
    
@@ -1518,6 +1979,60 @@ class QuerySetFromIterableTest(TestCase):
         pass
 
 
+class AtomicTest(TransactionTestCase):
+    """Check that the ``atomic`` decorator works as advertised"""
+    
+    def testCommitOK(self):
+        """If the decorated function returns, everything it wrote should be committed"""
+        @atomic
+        def create_types():
+            AccountType.objects.create(name='SPAM', base_type=AccountType.ASSET)
+            AccountType.objects.create(name='EGGS', base_type=AccountType.ASSET)
+            return 'done'
+        self.assertEqual(create_types(), 'done')
+        self.assertEqual(AccountType.objects.filter(name__in=['SPAM', 'EGGS']).count(), 2)
+        
+    def testRollbackOnFailure(self):
+        """If the decorated function raises an exception, nothing it wrote should be committed"""
+        @atomic
+        def create_types():
+            AccountType.objects.create(name='SPAM', base_type=AccountType.ASSET)
+            AccountType.objects.create(name='SPAM', base_type=AccountType.ASSET)
+        self.assertRaises(IntegrityError, create_types)
+        self.assertFalse(AccountType.objects.filter(name='SPAM').exists())
+
+
+class TotalAmountCacheTest(TransactionTestCase):
+    """Tests for the cache of total amounts of money stored within accounting systems"""
+    
+    def setUp(self):
+        self._cache_total_amount = simple_accounting.models.ACCOUNTING_CACHE_TOTAL_AMOUNT
+        simple_accounting.models.ACCOUNTING_CACHE_TOTAL_AMOUNT = True
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.gas = GAS.objects.create(name="GASteropode")
+        self.person_system = self.person.accounting.system
+        self.gas_system = self.gas.accounting.system
+        self.member = GASMember.objects.create(gas=self.gas, person=self.person)
+    
+    def tearDown(self):
+        cache.clear()
+        simple_accounting.models.ACCOUNTING_CACHE_TOTAL_AMOUNT = self._cache_total_amount
+    
+    def testInvalidatedAfterCommit(self):
+        """A total amount cached while a posting is being written should be invalidated once it's committed"""
+        self.assertEqual(self.person_system.total_amount, 0)
+        @atomic
+        def recharge():
+            register_transaction(self.person_system['/wallet'], self.person_system['/expenses/gas/' + self.gas.uid + '/recharges'], 
+                self.gas_system['/incomes/recharges'], self.gas_system['/members/' + self.member.uid], 20, "Recharge", self.person.subject, 
+                date=datetime(2011, 1, 1))
+            # a concurrent reader caches the total amount, before the posting is committed
+            cache.set(AccountSystem.total_amount_cache_key(self.person_system.pk), Decimal(0))
+        recharge()
+        self.assertEqual(self.person_system.total_amount, -20)
+        self.assertEqual(self.gas_system.total_amount, 20)
+
+
 class RegisterSplitTransactionTest(TestCase):
     """Check that the ``register_split_transaction()`` factory function works as advertised"""
    
@@ -1917,6 +2432,160 @@ class RegisterSimpleTransactionTest(TestCase):
         pass
         
         
+class RegisterTransactionsBulkTest(TestCase):
+    """Check that the ``register_transactions_bulk()`` factory function works as advertised"""
+   
+    def setUp(self):
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.gas = GAS.objects.create(name="GASteropode")
+        self.person_system = self.person.accounting.system
+        self.gas_system = self.gas.accounting.system
+        self.member = GASMember.objects.create(gas=self.gas, person=self.person)
+    
+    def testTransactionCreationOK(self):
+        """``register_transactions_bulk()`` should create the same rows as single-transaction factory functions"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        wallet = self.person_system['/wallet']
+        exit_point = self.person_system['/expenses/gas/' + self.gas.uid + '/recharges']
+        entry_point = self.gas_system['/incomes/recharges']
+        specs = [
+            {'source': wallet, 'exit_point': exit_point, 'entry_point': entry_point, 'target': member_account, 
+             'amount': 20, 'description': "Recharge", 'issuer': self.person.subject, 'kind': 'RECHARGE'},
+            {'source': member_account, 'target': self.gas_system['/cash'], 
+             'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject},
+        ]
+        (recharge, withdrawal) = register_transactions_bulk(specs)
+        # recharge
+        self.assertEqual((recharge.source.account, recharge.source.amount, recharge.kind), (wallet, 20, 'RECHARGE'))
+        self.assertEqual(len(recharge.splits), 1)
+        split = recharge.splits[0]
+        self.assertEqual((split.exit_point, split.entry_point, split.target.account, split.amount), (exit_point, entry_point, member_account, 20))
+        self.assertEqual(LedgerEntry.objects.get(transaction=recharge, account=wallet).amount, -20)
+        self.assertEqual(LedgerEntry.objects.get(transaction=recharge, account=exit_point).amount, 20)
+        self.assertEqual(LedgerEntry.objects.get(transaction=recharge, account=entry_point).amount, 20)
+        self.assertEqual(LedgerEntry.objects.get(transaction=recharge, account=member_account).amount, 20)
+        # withdrawal
+        self.assertTrue(withdrawal.is_simple)
+        entry = LedgerEntry.objects.get(transaction=withdrawal, account=member_account)
+        self.assertEqual((entry.amount, entry.entry_id, entry.balance_after), (-5, 2, 15))
+        # balances
+        self.assertEqual(member_account.balance, 15)
+        self.assertEqual(wallet.balance, -20)
+        self.assertEqual(self.gas_system['/cash'].balance, 5)
+        
+    def testFailIfAnySpecIsInvalid(self):
+        """If a transaction spec is invalid, raise ``MalformedTransaction`` and write nothing"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        specs = [
+            {'source': member_account, 'target': self.gas_system['/cash'], 'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject},
+            # placeholder target
+            {'source': member_account, 'target': self.gas_system['/members'], 'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject},
+        ]
+        self.assertRaises(MalformedTransaction, register_transactions_bulk, specs)
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(LedgerEntry.objects.count(), 0)
+        
+        
+class ValidateTransactionSpecsTest(TestCase):
+    """Check that the ``validate_transaction_specs()`` helper function works as advertised"""
+   
+    def setUp(self):
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.gas = GAS.objects.create(name="GASteropode")
+        self.person_system = self.person.accounting.system
+        self.gas_system = self.gas.accounting.system
+        self.member = GASMember.objects.create(gas=self.gas, person=self.person)
+    
+    def testOK(self):
+        """If every spec is valid, return an empty dictionary"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        specs = [
+            {'source': self.person_system['/wallet'], 'exit_point': self.person_system['/expenses/gas/' + self.gas.uid + '/recharges'], 
+             'entry_point': self.gas_system['/incomes/recharges'], 'target': member_account, 'amount': 20, 'description': "Recharge", 'issuer': self.person.subject},
+            {'source': member_account, 'splits': [{'target': self.gas_system['/cash'], 'amount': 3}, {'target': self.gas_system['/cash'], 'amount': 2}], 
+             'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject},
+        ]
+        self.assertEqual(validate_transaction_specs(specs), {})
+        
+    def testErrorsCollectedBySpec(self):
+        """Errors should be reported for each invalid spec, without writing anything"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        specs = [
+            {'source': member_account, 'target': self.gas_system['/cash'], 'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject},
+            # placeholder target, no description
+            {'source': member_account, 'target': self.gas_system['/members'], 'amount': 5, 'description': "", 'issuer': self.gas.subject},
+            # flux-like source, money not conserved
+            {'source': self.gas_system['/incomes/recharges'], 'amount': 5, 
+             'splits': [{'target': self.gas_system['/cash'], 'amount': 4}], 'description': "Withdrawal", 'issuer': self.gas.subject},
+        ]
+        errors = validate_transaction_specs(specs)
+        self.assertEqual(sorted(errors.keys()), [1, 2])
+        self.assertEqual(len(errors[1]), 2)
+        self.assertEqual(len(errors[2]), 2)
+        self.assertEqual(Transaction.objects.count(), 0)
+    
+    def testAccountsReadFromInstances(self):
+        """Accounts whose type has already been loaded shouldn't be retrieved from the DB again"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        cash = self.gas_system['/cash']
+        specs = [{'source': member_account, 'target': cash, 'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject}]
+        self.assertNumQueries(1, validate_transaction_specs, specs)
+        specs = [{'source': Account.objects.select_related('kind').get(pk=member_account.pk), 
+                  'target': Account.objects.select_related('kind').get(pk=cash.pk), 
+                  'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject}]
+        self.assertNumQueries(0, validate_transaction_specs, specs)
+        
+        
+class PostingQueueTest(TestCase):
+    """Check that the ``PostingQueue`` class works as advertised"""
+   
+    def setUp(self):
+        self.person = Person.objects.create(name="Mario", surname="Rossi")
+        self.gas = GAS.objects.create(name="GASteropode")
+        self.gas_system = self.gas.accounting.system
+        self.member = GASMember.objects.create(gas=self.gas, person=self.person)
+    
+    def testFlush(self):
+        """Submitted transactions should be registered in order of submission, rejecting invalid ones"""
+        member_account = self.gas_system['/members/' + self.member.uid]
+        queue = PostingQueue(batch_size=2)
+        pending = []
+        for (amount, target) in ((5, '/cash'), (3, '/members'), (2, '/cash'), (1, '/cash')):
+            spec = {'source': member_account, 'target': self.gas_system[target], 'amount': amount, 'description': "Withdrawal", 'issuer': self.gas.subject}
+            pending.append(queue.submit(spec))
+        self.assertFalse(pending[0].done())
+        queue.flush()
+        self.assertTrue(pending[0].done())
+        # the second transaction targets a placeholder account
+        self.assertRaises(MalformedTransaction, pending[1].result)
+        entries = LedgerEntry.objects.filter(account=member_account).order_by('entry_id')
+        self.assertEqual([entry.transaction for entry in entries], [pending[0].result(), pending[2].result(), pending[3].result()])
+        self.assertEqual([entry.balance_after for entry in entries], [-5, -7, -8])
+    
+    def testWorkerSurvivesFailures(self):
+        """If a batch can't be processed, its transactions should fail, while the worker thread keeps running"""
+        import simple_accounting.utils
+        # the worker thread can't share the (in-memory) test DB, so keep it away from the DB
+        def failing_validation(specs):
+            raise MalformedTransaction("Validation failed")
+        (orig_validate, orig_register) = (simple_accounting.utils.validate_transaction_specs, simple_accounting.utils.register_transactions_bulk)
+        simple_accounting.utils.validate_transaction_specs = failing_validation
+        simple_accounting.utils.register_transactions_bulk = lambda specs: [spec['description'] for spec in specs]
+        queue = PostingQueue()
+        try:
+            queue.start()
+            failed = queue.submit({'amount': 5, 'description': "Withdrawal", 'issuer': self.gas.subject})
+            self.assertRaises(MalformedTransaction, failed.result, 5)
+            queue.flush()
+            simple_accounting.utils.validate_transaction_specs = lambda specs: {}
+            registered = queue.submit({'amount': 3, 'description': "Recharge", 'issuer': self.gas.subject})
+            queue.flush()
+            self.assertEqual(registered.result(5), "Recharge")
+        finally:
+            queue.stop()
+            (simple_accounting.utils.validate_transaction_specs, simple_accounting.utils.register_transactions_bulk) = (orig_validate, orig_register)
+        
+        
 class UpdateTransactionTest(TestCase):
     """Check that the ``update_transaction()`` factory function works as advertised"""
    
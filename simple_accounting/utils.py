@@ -14,12 +14,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-simple-accounting``. If not, see <http://www.gnu.org/licenses/>.
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Sum
+from django.utils.translation import ugettext as _
 
 from simple_accounting.models import Transaction, CashFlow, Split, LedgerEntry
-from simple_accounting.models import AccountType
+from simple_accounting.models import AccountType, Account
+from simple_accounting.lib import bulk_insert, atomic
 from simple_accounting.exceptions import MalformedTransaction
 
+from datetime import datetime
+import Queue
+import threading
+
 
 def transaction_details(transaction):
     """
@@ -50,6 +59,7 @@ def transaction_details(transaction):
     return display_str    
     
     
+@atomic
 def register_split_transaction(source, splits, description, issuer, date=None, kind=None):
     """
     A factory function for registering general (split) transactions between accounts.
@@ -91,14 +101,19 @@ def register_split_transaction(source, splits, description, issuer, date=None, k
     If input is valid, return the newly created ``Transaction`` model instance; 
     otherwise, report to the client code whatever error(s) occurred during the processing, 
     by raising a ``MalformedTransaction`` exception. 
+    
+    The transaction is written atomically (see ``simple_accounting.lib.atomic``).
     """    
+    # validate the transaction before writing anything to the DB
+    _check_transaction_spec({'source': source.account, 'amount': source.amount, 'description': description, 'issuer': issuer, 'kind': kind,
+                             'splits': [{'exit_point': split.exit_point, 'entry_point': split.entry_point, 'target': split.target.account, 'amount': split.amount} for split in splits]})
     try:
         transaction = Transaction()
         
         transaction.source = source
         transaction.description = description
         transaction.issuer = issuer 
-        transaction.date = date
+        transaction.date = date or datetime.now()
         transaction.kind = kind
         
         transaction.save()
@@ -111,23 +126,26 @@ def register_split_transaction(source, splits, description, issuer, date=None, k
     
     ## write ledger entries
     # source account
-    LedgerEntry.objects.create(account=source.account, transaction=transaction, amount=-source.amount)
+    entries = [LedgerEntry(account=source.account, transaction=transaction, amount=-source.amount)]
     # splits
     for split in splits:
         if split.exit_point: 
             # the sign of a ledger entry depends on the type of account involved 
             sign = 1 if split.exit_point.base_type == AccountType.EXPENSE else -1
-            LedgerEntry.objects.create(account=split.exit_point, transaction=transaction, amount=sign*split.amount)
+            entries.append(LedgerEntry(account=split.exit_point, transaction=transaction, amount=sign*split.amount))
             # the sign of a ledger entry depends on the type of account involved
             sign = 1 if split.entry_point.base_type == AccountType.INCOME else -1
-            LedgerEntry.objects.create(account=split.entry_point, transaction=transaction, amount=sign*split.amount) 
+            entries.append(LedgerEntry(account=split.entry_point, transaction=transaction, amount=sign*split.amount)) 
         # target account
         # note that, by definition, ``split.amount == - split.target.amount)                
-        LedgerEntry.objects.create(account=split.target.account, transaction=transaction, amount=split.amount)
+        entries.append(LedgerEntry(account=split.target.account, transaction=transaction, amount=split.amount))
+    # accounts are locked in a fixed order, so concurrent transactions can't deadlock 
+    LedgerEntry.objects.write_entries(entries)
     
     return transaction
 
 
+@atomic
 def register_transaction(source_account, exit_point, entry_point, target_account, amount, description, issuer, date=None, kind=None):
     """
     A factory function for registering (non-split) transactions between accounts
@@ -182,7 +200,12 @@ def register_transaction(source_account, exit_point, entry_point, target_account
     If input is valid, return the newly created ``Transaction`` model instance; 
     otherwise, report to the client code whatever error(s) occurred during the processing, 
     by raising a ``MalformedTransaction`` exception. 
+    
+    The transaction is written atomically (see ``simple_accounting.lib.atomic``).
     """    
+    # validate the transaction before writing anything to the DB
+    _check_transaction_spec({'source': source_account, 'exit_point': exit_point, 'entry_point': entry_point, 'target': target_account, 
+                             'amount': amount, 'description': description, 'issuer': issuer, 'kind': kind})
     try:
         transaction = Transaction()
         
@@ -191,7 +214,7 @@ def register_transaction(source_account, exit_point, entry_point, target_account
         transaction.source = source
         transaction.description = description
         transaction.issuer = issuer 
-        transaction.date = date
+        transaction.date = date or datetime.now()
         transaction.kind = kind
         
         transaction.save()
@@ -209,20 +232,23 @@ def register_transaction(source_account, exit_point, entry_point, target_account
     
     ## write ledger entries
     # source account
-    LedgerEntry.objects.create(account=source_account, transaction=transaction, amount=-amount)
+    entries = [LedgerEntry(account=source_account, transaction=transaction, amount=-amount)]
     # exit point account
     # the sign of a ledger entry depends on the type of account involved 
     sign = 1 if exit_point.base_type == AccountType.EXPENSE else -1
-    LedgerEntry.objects.create(account=exit_point, transaction=transaction, amount=sign*amount)
+    entries.append(LedgerEntry(account=exit_point, transaction=transaction, amount=sign*amount))
     # the sign of a ledger entry depends on the type of account involved
     sign = 1 if entry_point.base_type == AccountType.INCOME else -1
-    LedgerEntry.objects.create(account=entry_point, transaction=transaction, amount=sign*amount) 
+    entries.append(LedgerEntry(account=entry_point, transaction=transaction, amount=sign*amount)) 
     # target account
-    LedgerEntry.objects.create(account=target_account, transaction=transaction, amount=amount)
+    entries.append(LedgerEntry(account=target_account, transaction=transaction, amount=amount))
+    # accounts are locked in a fixed order, so concurrent transactions can't deadlock 
+    LedgerEntry.objects.write_entries(entries)
     
     return transaction
  
 
+@atomic
 def register_internal_transaction(source, targets, description, issuer, date=None, kind=None):
     """
     A factory function for registering internal transactions.
@@ -270,14 +296,19 @@ def register_internal_transaction(source, targets, description, issuer, date=Non
     If input is valid, return the newly created ``Transaction`` model instance; 
     otherwise, report to the client code whatever error(s) occurred during the processing, 
     by raising a ``MalformedTransaction`` exception.  
+    
+    The transaction is written atomically (see ``simple_accounting.lib.atomic``).
     """
+    # validate the transaction before writing anything to the DB
+    _check_transaction_spec({'source': source.account, 'amount': source.amount, 'description': description, 'issuer': issuer, 'kind': kind,
+                             'splits': [{'target': target.account, 'amount': -target.amount} for target in targets]})
     try:
         transaction = Transaction()
         
         transaction.source = source
         transaction.description = description
         transaction.issuer = issuer 
-        transaction.date = date
+        transaction.date = date or datetime.now()
         transaction.kind = kind
         
         transaction.save()
@@ -298,14 +329,17 @@ def register_internal_transaction(source, targets, description, issuer, date=Non
     
     ## write ledger entries
     # source account
-    LedgerEntry.objects.create(account=source.account, transaction=transaction, amount=-source.amount)
+    entries = [LedgerEntry(account=source.account, transaction=transaction, amount=-source.amount)]
     # target accounts
     for target in targets:
-        LedgerEntry.objects.create(account=target.account, transaction=transaction, amount=-target.amount)
+        entries.append(LedgerEntry(account=target.account, transaction=transaction, amount=-target.amount))
+    # accounts are locked in a fixed order, so concurrent transactions can't deadlock 
+    LedgerEntry.objects.write_entries(entries)
     
     return transaction
 
 
+@atomic
 def register_simple_transaction(source_account, target_account, amount, description, issuer, date=None, kind=None):
     """
     A factory function for registering simple transactions.
@@ -353,7 +387,12 @@ def register_simple_transaction(source_account, target_account, amount, descript
     If input is valid, return the newly created ``Transaction`` model instance; 
     otherwise, report to the client code whatever error(s) occurred during the processing, 
     by raising a ``MalformedTransaction`` exception.  
+    
+    The transaction is written atomically (see ``simple_accounting.lib.atomic``).
     """
+    # validate the transaction before writing anything to the DB
+    _check_transaction_spec({'source': source_account, 'target': target_account, 
+                             'amount': amount, 'description': description, 'issuer': issuer, 'kind': kind})
     try:
         transaction = Transaction()
         
@@ -362,7 +401,7 @@ def register_simple_transaction(source_account, target_account, amount, descript
         transaction.source = source
         transaction.description = description
         transaction.issuer = issuer 
-        transaction.date = date
+        transaction.date = date or datetime.now()
         transaction.kind = kind
         
         transaction.save()
@@ -381,13 +420,394 @@ def register_simple_transaction(source_account, target_account, amount, descript
     
     ## write ledger entries
     # source account
-    LedgerEntry.objects.create(account=source_account, transaction=transaction, amount=-amount)
+    entries = [LedgerEntry(account=source_account, transaction=transaction, amount=-amount)]
     # target account
-    LedgerEntry.objects.create(account=target_account, transaction=transaction, amount=amount)
+    entries.append(LedgerEntry(account=target_account, transaction=transaction, amount=amount))
+    # accounts are locked in a fixed order, so concurrent transactions can't deadlock 
+    LedgerEntry.objects.write_entries(entries)
     
     return transaction
 
 
+def _normalize_transaction_spec(spec):
+    # take a transaction spec (see ``register_transactions_bulk``) and return a normalized copy of it,
+    # where splits are always listed (as dictionaries) under the ``splits`` key 
+    spec = dict(spec)
+    if 'splits' not in spec:
+        spec['splits'] = [{
+            'exit_point': spec.pop('exit_point', None), 
+            'entry_point': spec.pop('entry_point', None), 
+            'target': spec.pop('target', None), 
+            'amount': spec.get('amount'),
+        }]
+    spec['splits'] = [dict(split) for split in spec['splits']]
+    spec['date'] = spec.get('date') or datetime.now()
+    spec.setdefault('kind', None)
+    return spec
+
+
+def _transaction_spec_errors(spec, accounts):
+    # return the list of errors making a (normalized) transaction spec not compliant with 
+    # the reference accounting model; ``accounts`` maps IDs of accounts involved in the 
+    # transaction to 3-tuples ``(base_type, system_id, is_placeholder)``  
+    stock_types = (AccountType.ASSET, AccountType.LIABILITY)
+    flux_types = (AccountType.INCOME, AccountType.EXPENSE)
+    errors = []
+    if not spec.get('description'):
+        errors.append(_(u"A description is required"))
+    elif len(spec['description']) > Transaction._meta.get_field('description').max_length:
+        errors.append(_(u"Description is too long"))
+    if not spec.get('issuer'):
+        errors.append(_(u"An issuer is required"))
+    if spec['kind'] and spec['kind'] not in dict(settings.TRANSACTION_TYPES):
+        errors.append(_(u"Invalid transaction type: %s") % spec['kind'])
+    if not spec.get('source') or spec.get('amount') is None:
+        errors.append(_(u"Both a source account and an amount are required"))
+        return errors
+    if not spec['splits']:
+        errors.append(_(u"At least a split is required"))
+        return errors
+    involved_accounts = [spec['source']]
+    for split in spec['splits']:
+        if not split.get('target') or split.get('amount') is None:
+            errors.append(_(u"Both a target account and an amount are required for each split"))
+            return errors
+        involved_accounts.append(split['target'])
+        for key in ('exit_point', 'entry_point'):
+            if split.get(key):
+                involved_accounts.append(split[key])
+    missing = [account for account in involved_accounts if account.pk not in accounts]
+    if missing:
+        errors.append(_(u"These accounts don't exist: %s") % ", ".join([unicode(account) for account in missing]))
+        return errors
+    (source_type, source_system, source_is_placeholder) = accounts[spec['source'].pk]
+    if source_type not in stock_types:
+        errors.append(_(u"Only stock-like accounts may represent cash-flows."))
+    for split in spec['splits']:
+        (target_type, target_system, target_is_placeholder) = accounts[split['target'].pk]
+        if target_type not in stock_types:
+            errors.append(_(u"Target must be a stock-like account"))
+        if split.get('exit_point'):
+            if not split.get('entry_point'):
+                errors.append(_(u"If an exit-point is set for a split, an entry-point must be set, too."))
+                continue
+            (exit_type, exit_system, exit_is_placeholder) = accounts[split['exit_point'].pk]
+            (entry_type, entry_system, entry_is_placeholder) = accounts[split['entry_point'].pk]
+            if exit_type not in flux_types:
+                errors.append(_(u"Exit-points must be flux-like accounts"))
+            if entry_type not in flux_types:
+                errors.append(_(u"Entry-points must be flux-like accounts"))
+            if entry_system != target_system:
+                errors.append(_(u"Entry-point and target accounts must belong to the same accounting system"))
+            if exit_system != source_system:
+                errors.append(_(u"Exit-points must belong to the same accounting system as the source account"))
+        elif split.get('entry_point'):
+            errors.append(_(u"If no exit-point is set for a split, no entry-point must be set, either."))
+        elif target_system != source_system:
+            errors.append(_(u"For internal splits, target accounts must belong to the same accounting system as the source account"))
+    ## check that the *law of conservation of money* is satisfied
+    if spec['amount'] != sum([split['amount'] for split in spec['splits']]):
+        errors.append(_(u"The law of conservation of money is not satisfied for this transaction"))
+    if [account for account in involved_accounts if accounts[account.pk][2]]:
+        errors.append(_(u"Placeholder accounts can't directly contain transactions, only sub-accounts"))
+    # the same error may be found on more than one split
+    return sorted(set(errors), key=errors.index)
+
+
+def _accounts_info(specs):
+    # retrieve the info needed to validate (normalized) transaction specs, as a dictionary 
+    # mapping account IDs to 3-tuples ``(base_type, system_id, is_placeholder)``; 
+    # it's read from given ``Account`` instances if their type has already been loaded,
+    # while the remaining accounts are retrieved by a single query (if any) 
+    kind_cache = Account._meta.get_field('kind').get_cache_name()
+    accounts = {}
+    account_ids = set()
+    for spec in specs:
+        involved_accounts = [spec.get('source')]
+        for split in spec['splits']:
+            involved_accounts += [split.get(key) for key in ('exit_point', 'entry_point', 'target')]
+        for account in involved_accounts:
+            if not account or account.pk is None:
+                continue
+            if hasattr(account, kind_cache):
+                accounts[account.pk] = (account.kind.base_type, account.system_id, account.is_placeholder)
+            else:
+                account_ids.add(account.pk)
+    account_ids -= set(accounts.keys())
+    if account_ids:
+        for (account_id, base_type, system_id, is_placeholder) in Account.objects.filter(pk__in=account_ids).values_list('pk', 'kind__base_type', 'system', 'is_placeholder'):
+            accounts[account_id] = (base_type, system_id, is_placeholder) 
+    return accounts
+
+
+def validate_transaction_specs(specs):
+    """
+    Check a batch of transaction specs (as accepted by ``register_transactions_bulk``) against 
+    the reference accounting model (for details, see ``Transaction`` model's docstring), 
+    without writing anything to the DB.
+    
+    Every rule enforced when transactions are saved is checked: required fields, account kinds,
+    entry- & exit- points, accounting systems of involved accounts, placeholder accounts and 
+    the *law of conservation of money*. Accounts involved are read from given ``Account`` instances 
+    when their type has already been loaded, otherwise they are retrieved by a single query, 
+    no matter how many specs are given.
+    
+    Return a dictionary mapping the index (within ``specs``) of each invalid spec to the list 
+    of error messages found for it; if every spec is valid, return an empty dictionary.
+    """
+    specs = [_normalize_transaction_spec(spec) for spec in specs]
+    return _validate_normalized_specs(specs, _accounts_info(specs))
+
+
+def _validate_normalized_specs(specs, accounts):
+    errors = {}
+    for (i, spec) in enumerate(specs):
+        spec_errors = _transaction_spec_errors(spec, accounts)
+        if spec_errors:
+            errors[i] = spec_errors
+    return errors
+
+
+def _check_transaction_spec(spec):
+    # used by factory functions to validate a transaction before writing anything to the DB; 
+    # if ``spec`` is invalid, raise ``MalformedTransaction``
+    errors = validate_transaction_specs([spec])
+    if errors:
+        err_msg = _(u"Transaction \"%(description)s\" is invalid.  The following error(s) occured: %(errors)s")\
+            % {'description':spec.get('description'), 'errors':' '.join(errors[0])}
+        raise MalformedTransaction(err_msg)
+
+
+@atomic
+def register_transactions_bulk(specs):
+    """
+    A factory function for registering a batch of transactions at once.
+    
+    Each transaction is specified by a dictionary, with these keys:
+    ``source``
+        the source account for the transaction (a stock-like ``Account`` model instance)
+    ``amount``
+        the amount of money flowing from/to the source account (as a signed decimal); 
+        its sign determines the flows's direction (i.e., positive -> outgoing, negative -> incoming)  
+    ``splits``
+        a list of dictionaries describing the splits composing the transaction, with keys 
+        ``target`` (the target account), ``amount`` (the amount of money flowing through the split), 
+        ``exit_point`` and ``entry_point`` (only for splits across accounting systems), 
+        and ``description`` (optional)
+    ``description``, ``issuer``, ``date`` (optional), ``kind`` (optional)
+        as for ``register_split_transaction``
+    
+    For non-split transactions, ``splits`` may be omitted, specifying ``target``
+    (along with ``exit_point`` and ``entry_point``, if needed) directly within the transaction spec.
+    
+    The rows written to the DB (cash-flows, transactions, splits and ledger entries) are the same 
+    as if transactions were registered one at a time (e.g. by ``register_transaction``), but:
+    * the whole batch is validated in memory before writing anything (see ``validate_transaction_specs``);
+      if a transaction spec is invalid, raise ``MalformedTransaction``  
+    * model validation and related queries are skipped, ledger entries are inserted by a single 
+      multi-row statement, and the balance of each account involved is updated once
+    * everything happens within a single DB transaction (see ``simple_accounting.lib.atomic``)
+    
+    Return the list of newly created ``Transaction`` model instances (in the same order as ``specs``).
+    """
+    specs = [_normalize_transaction_spec(spec) for spec in specs]
+    ## validation 
+    accounts = _accounts_info(specs)
+    errors = _validate_normalized_specs(specs, accounts)
+    if errors:
+        i = min(errors.keys())
+        raise MalformedTransaction(_(u"Transaction spec #%(index)s is invalid: %(errors)s") % {'index': i, 'errors': ' '.join(errors[i])})
+    ## writing
+    # bypass model-level ``.save()`` methods, since validation has already been performed
+    insert = lambda instance: models.Model.save(instance, force_insert=True)
+    transactions = []
+    split_links = []
+    entries = []
+    for spec in specs:
+        source = CashFlow(account=spec['source'], amount=spec['amount'])
+        insert(source)
+        transaction = Transaction(source=source, description=spec['description'], issuer=spec['issuer'], date=spec['date'], kind=spec['kind'])
+        insert(transaction)
+        transactions.append(transaction)
+        entries.append(LedgerEntry(account=spec['source'], transaction=transaction, amount=-spec['amount']))
+        for split_spec in spec['splits']:
+            (exit_point, entry_point, amount) = (split_spec.get('exit_point'), split_spec.get('entry_point'), split_spec['amount'])
+            target = CashFlow(account=split_spec['target'], amount=-amount)
+            insert(target)
+            split = Split(exit_point=exit_point, entry_point=entry_point, target=target, description=split_spec.get('description', ''))
+            insert(split)
+            split_links.append(Transaction.split_set.through(transaction=transaction, split=split))
+            if exit_point:
+                # the sign of a ledger entry depends on the type of account involved 
+                sign = 1 if accounts[exit_point.pk][0] == AccountType.EXPENSE else -1
+                entries.append(LedgerEntry(account=exit_point, transaction=transaction, amount=sign*amount))
+                sign = 1 if accounts[entry_point.pk][0] == AccountType.INCOME else -1
+                entries.append(LedgerEntry(account=entry_point, transaction=transaction, amount=sign*amount))
+            entries.append(LedgerEntry(account=split_spec['target'], transaction=transaction, amount=amount))
+    bulk_insert(Transaction.split_set.through, split_links)
+    LedgerEntry.objects.write_entries(entries)
+    return transactions
+
+
+class PendingTransaction(object):
+    """
+    A handle to a transaction submitted to a ``PostingQueue``, which may not have been registered yet.
+    """
+    def __init__(self, spec):
+        # the (normalized) transaction spec
+        self.spec = spec
+        self._processed = threading.Event()
+        self._transaction = None
+        self._error = None
+    
+    def done(self):
+        """
+        Return ``True`` if the transaction has already been processed (either successfully or not);
+        ``False`` otherwise.
+        """
+        return self._processed.is_set()
+    
+    def result(self, timeout=None):
+        """
+        Wait until the transaction has been processed, then return the newly created 
+        ``Transaction`` model instance; if the transaction couldn't be registered, 
+        raise the exception occurred (e.g. ``MalformedTransaction``).
+        
+        If ``timeout`` is given and the transaction hasn't been processed within 
+        that many seconds, return ``None``. 
+        """
+        self._processed.wait(timeout)
+        if not self._processed.is_set():
+            return None
+        if self._error is not None:
+            raise self._error
+        return self._transaction
+    
+    def _set_result(self, transaction=None, error=None):
+        (self._transaction, self._error) = (transaction, error)
+        self._processed.set()
+
+
+class PostingQueue(object):
+    """
+    A queue of transactions waiting to be registered, so that callers (e.g. request handlers) 
+    don't have to wait for them to be written to the DB.
+    
+    Transactions are submitted as specs (see ``register_transactions_bulk``), getting back 
+    a ``PendingTransaction`` handle. A background worker thread drains the queue in batches, 
+    taking whatever has been submitted in the meantime (up to ``batch_size`` transactions), 
+    and registers each batch by ``register_transactions_bulk``. Since there is a single worker 
+    and batches are processed in order of submission, entries are written to each ledger 
+    in the same order as their transactions were submitted.
+    
+    Invalid specs are rejected (see ``validate_transaction_specs``) without affecting the other 
+    transactions in their batch; if writing a batch to the DB fails, all of its transactions fail. 
+    
+    Until the worker thread is started (by ``.start()``), submitted transactions are registered 
+    only when ``.flush()`` is called, within the calling thread.
+    
+    Note that the worker thread uses a DB connection of its own, so it requires a database 
+    accessible by multiple connections (i.e. not an in-memory SQLite one).
+    """
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self._queue = Queue.Queue()
+        self._worker = None
+    
+    def submit(self, spec):
+        """
+        Add the transaction specified by ``spec`` to the queue, and return 
+        a ``PendingTransaction`` handle to it.
+        
+        If no date is specified, the transaction is dated when it's submitted, not when it's registered. 
+        """
+        pending = PendingTransaction(_normalize_transaction_spec(spec))
+        self._queue.put(pending)
+        return pending
+    
+    def start(self):
+        """
+        Start the worker thread, if not already running.
+        """
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+    
+    def stop(self):
+        """
+        Register the transactions submitted so far, then stop the worker thread.
+        """
+        if self._worker is not None:
+            # tell the worker to exit, once the queue has been drained
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+    
+    def flush(self):
+        """
+        Block until every transaction submitted so far has been processed.
+        """
+        if self._worker is None:
+            while self._process_batch(block=False):
+                pass
+        else:
+            self._queue.join()
+    
+    def _run(self):
+        from django.db import connection
+        try:
+            while self._process_batch(block=True):
+                pass
+        finally:
+            # the worker thread has its own DB connection, so make sure to release it 
+            connection.close()
+    
+    def _process_batch(self, block):
+        # take (at most) ``batch_size`` transactions from the queue and register them;
+        # return ``False`` if there was nothing to process, or if the worker has been asked to stop 
+        batch = []
+        stopping = False
+        while len(batch) < self.batch_size:
+            try:
+                # only wait for the first transaction of the batch
+                pending = self._queue.get(block and not batch)
+            except Queue.Empty:
+                break
+            if pending is None:
+                self._queue.task_done()
+                stopping = True
+                break
+            batch.append(pending)
+        if batch:
+            try:
+                self._register(batch)
+            finally:
+                # otherwise, ``.flush()`` would block forever
+                for pending in batch:
+                    self._queue.task_done()
+        return bool(batch) and not stopping
+    
+    def _register(self, batch):
+        # register the transactions in ``batch``, setting the result of each of them; 
+        # errors don't propagate, so that the worker thread keeps running 
+        try:
+            errors = validate_transaction_specs([pending.spec for pending in batch])
+            for (i, messages) in errors.items():
+                batch[i]._set_result(error=MalformedTransaction(_(u"Transaction spec is invalid: %s") % ' '.join(messages)))
+            valid = [pending for (i, pending) in enumerate(batch) if i not in errors]
+            if valid:
+                transactions = register_transactions_bulk([pending.spec for pending in valid])
+                for (pending, transaction) in zip(valid, transactions):
+                    pending._set_result(transaction=transaction)
+        except Exception, e:
+            # e.g. the DB is unreachable: fail every transaction still waiting for a result
+            for pending in batch:
+                if not pending.done():
+                    pending._set_result(error=e)
+
+
+@atomic
 def update_transaction(transaction, **kwargs):
     """
     Take an existing transaction and update it as specified by passed arguments; 
@@ -445,4 +865,78 @@ def update_transaction(transaction, **kwargs):
         new_params.update(kwargs)
         transaction = register_split_transaction(**new_params)
               
-    return transaction
\ No newline at end of file
+    return transaction
+
+
+class TrialBalance(object):
+    """
+    A trial balance for an accounting system, i.e. the list of its accounts 
+    along with the total of debits and credits registered on each of them
+    during a given period.
+    
+    Iterating over a trial balance yields a row for each account having ledger entries 
+    within that period, as a tuple ``(path, section, debit, credit)``, where ``section`` is 
+    the basic type of the account (e.g. ``AccountType.ASSET``); rows are ordered by section, 
+    then by path.
+    
+    A ledger entry is accounted as a debit if it increases the balance of an asset, liability 
+    or expense account, or if it decreases the balance of an income account; as a credit otherwise.
+    """
+    SECTIONS = (AccountType.ROOT, AccountType.ASSET, AccountType.LIABILITY, AccountType.INCOME, AccountType.EXPENSE)
+    
+    def __init__(self, system, start=None, end=None):
+        self.system = system
+        self.start = start
+        self.end = end
+        entries = LedgerEntry.objects.filter(account__system=system)
+        if start:
+            entries = entries.filter(transaction__date__gte=start)
+        if end:
+            entries = entries.filter(transaction__date__lte=end)
+        # sum up positive and negative entries by account, using two aggregate queries
+        positive_totals = dict(entries.filter(amount__gt=0).values_list('account').annotate(total=Sum('amount')))
+        negative_totals = dict(entries.filter(amount__lt=0).values_list('account').annotate(total=Sum('amount')))
+        # retrieve paths and types of accounts, without building model instances
+        accounts = {}
+        for (account_id, path, section) in Account.objects.filter(system=system).values_list('pk', 'path', 'kind__base_type'):
+            accounts[account_id] = (path, section)
+        self.total_debit = 0
+        self.total_credit = 0
+        self._rows = []
+        for account_id in set(positive_totals.keys()) | set(negative_totals.keys()):
+            positive = positive_totals.get(account_id, 0)
+            negative = -negative_totals.get(account_id, 0)
+            (path, section) = accounts[account_id]
+            # income accounts are credited when their balance increases
+            if section == AccountType.INCOME:
+                (debit, credit) = (negative, positive)
+            else:
+                (debit, credit) = (positive, negative)
+            self.total_debit += debit
+            self.total_credit += credit
+            self._rows.append((self.SECTIONS.index(section), path, section, debit, credit))
+        self._rows.sort()
+    
+    @property
+    def is_balanced(self):
+        """
+        Return ``True`` if total debits equal total credits, ``False`` otherwise.
+        """
+        return self.total_debit == self.total_credit
+    
+    def __iter__(self):
+        for (section_index, path, section, debit, credit) in self._rows:
+            yield (path, section, debit, credit)
+        
+
+def trial_balance(system, start=None, end=None):
+    """
+    Return the trial balance (as a ``TrialBalance`` instance) for the accounting system ``system``,
+    taking into account only transactions happened between ``start`` and ``end`` (both included);
+    if ``start`` (``end``) is not specified, the period is unbounded on the left (right).
+    
+    The trial balance is built from two aggregate queries over ledger entries 
+    (plus one query for retrieving account paths and types), no matter how many 
+    accounts or entries are involved.
+    """
+    return TrialBalance(system, start, end)